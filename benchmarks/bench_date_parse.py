@@ -0,0 +1,34 @@
+import argparse
+import timeit
+import pandas as pd
+from noaa_etls.lib.noaa_csv_lib import parse_normal_hly_dates
+
+
+def legacy_parse(date_col, year):
+    return pd.to_datetime(date_col.map(lambda x: f"{year}-{x}"))
+
+
+def run_benchmark(csv_path, year, copies, repeats):
+    dates = pd.read_csv(csv_path, usecols=["DATE"], dtype=str)["DATE"]
+    dates = pd.concat([dates] * copies, ignore_index=True)
+
+    legacy = legacy_parse(dates, year)
+    vectorized = parse_normal_hly_dates(dates, year)
+    if not (legacy.values == vectorized.values).all():
+        raise AssertionError("Vectorized parser disagrees with the legacy parser")
+
+    legacy_time = min(timeit.repeat(lambda: legacy_parse(dates, year), number=1, repeat=repeats))
+    vectorized_time = min(timeit.repeat(lambda: parse_normal_hly_dates(dates, year), number=1, repeat=repeats))
+    print(f"rows: {len(dates)}")
+    print(f"legacy to_datetime: {legacy_time:.4f}s")
+    print(f"vectorized:         {vectorized_time:.4f}s ({legacy_time / vectorized_time:.1f}x)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark NORMAL_HLY DATE parsing")
+    parser.add_argument("-i", "--input_path", default="test_data/3033900.csv")
+    parser.add_argument("-y", "--year", default=2010, type=int)
+    parser.add_argument("-n", "--copies", help="times to repeat the input rows", default=100, type=int)
+    parser.add_argument("-r", "--repeats", default=5, type=int)
+    args = parser.parse_args()
+    run_benchmark(args.input_path, args.year, args.copies, args.repeats)
@@ -0,0 +1,56 @@
+import argparse
+import pathlib
+import tempfile
+import pandas as pd
+from noaa_etls.lib.noaa_csv_lib import load_csv_raw, rename_raw_df
+from noaa_etls.etls.raw_to_staging import CATEGORY_EXTRACTORS, extract_station_info
+
+
+def legacy_load(csv_path, year):
+    # The parse before the compact schema: pandas defaults, with only the text columns pinned to str
+    header = pd.read_csv(csv_path, nrows=0).columns
+    dtypes = {c: str for c in header if c in ["STATION", "NAME", "DATE"] or c.endswith("_ATTRIBUTES")}
+    return rename_raw_df(pd.read_csv(csv_path, dtype=dtypes), year)
+
+
+def build_multi_station_csv(csv_path, stations, out_path):
+    # One year of the sample station, repeated under made up station ids
+    raw_df = pd.read_csv(csv_path, dtype=str)
+    frames = []
+    for i in range(stations):
+        frames.append(raw_df.assign(STATION=f"USW{i:08d}", NAME=f"STATION {i}"))
+    pd.concat(frames, ignore_index=True).to_csv(out_path, index=False)
+
+
+def frame_memory(df):
+    return df.memory_usage(deep=True, index=False).sum()
+
+
+def report(name, legacy_df, compact_df):
+    legacy = frame_memory(legacy_df)
+    compact = frame_memory(compact_df)
+    print(f"{name:<10} {legacy / 1e6:>10.1f} MB {compact / 1e6:>10.1f} MB {legacy / compact:>6.1f}x")
+
+
+def run_benchmark(csv_path, year, stations):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        multi_path = pathlib.Path(tmp_dir, "multi_station.csv")
+        build_multi_station_csv(csv_path, stations, multi_path)
+        legacy_df = legacy_load(multi_path, year)
+        compact_df = load_csv_raw(multi_path, year)
+
+    print(f"rows: {len(compact_df)} ({stations} stations)")
+    print(f"{'frame':<10} {'legacy':>13} {'compact':>13} {'saved':>7}")
+    report("raw", legacy_df, compact_df)
+    report("stations", extract_station_info(legacy_df), extract_station_info(compact_df))
+    for name, extractor in CATEGORY_EXTRACTORS.items():
+        report(name, extractor(legacy_df), extractor(compact_df))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare memory of default and compact NORMAL_HLY dtypes")
+    parser.add_argument("-i", "--input_path", default="test_data/3033900.csv")
+    parser.add_argument("-y", "--year", default=2010, type=int)
+    parser.add_argument("-s", "--stations", help="stations in the generated year of data", default=50, type=int)
+    args = parser.parse_args()
+    run_benchmark(args.input_path, args.year, args.stations)
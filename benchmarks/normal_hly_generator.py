@@ -0,0 +1,106 @@
+import csv
+import argparse
+import pathlib
+import numpy as np
+import pandas as pd
+from noaa_etls.lib.noaa_csv_lib import get_column_dtype, INTEGER_DTYPE
+
+# NORMAL_HLY marks missing or suppressed values with large negative codes (-7777, -9999, ...)
+SPECIAL_VALUE_LIMIT = -6666
+
+
+def read_template(template_path):
+    return pd.read_csv(template_path, dtype={"STATION": str, "NAME": str, "DATE": str}, keep_default_na=False)
+
+
+def get_value_columns(template):
+    return [c for c in template.columns if c.startswith("HLY-") and not c.endswith("_ATTRIBUTES")]
+
+
+def perturb(values, noise, integral):
+    # Shift real readings only, special value codes stay as they are
+    real = values > SPECIAL_VALUE_LIMIT
+    if integral:
+        shifted = np.clip(np.rint(values + noise), 0, None)
+    else:
+        shifted = np.round(values + noise, 1)
+    return np.where(real, shifted, values)
+
+
+def generate_station(template, value_columns, station_index, year_rng, seed):
+    # Each station is the template shifted by its own offsets plus hourly noise for the year. The station
+    # metadata and offsets only depend on the station, so every year agrees on them.
+    station_rng = np.random.default_rng([seed, station_index])
+    station_df = template.copy()
+    station_df["STATION"] = f"USW9{station_index:07d}"
+    station_df["NAME"] = f"SYNTHETIC STATION {station_index}"
+    station_df["LATITUDE"] = np.round(template["LATITUDE"] + station_rng.uniform(-5, 5), 5)
+    station_df["LONGITUDE"] = np.round(template["LONGITUDE"] + station_rng.uniform(-5, 5), 5)
+    station_df["ELEVATION"] = np.round(template["ELEVATION"] + station_rng.uniform(-500, 500), 1)
+    for c in value_columns:
+        integral = get_column_dtype(c) == INTEGER_DTYPE
+        noise = year_rng.normal(station_rng.normal(0, 2), 0.5, len(template))
+        station_df[c] = perturb(template[c].to_numpy(dtype="float64"), noise, integral)
+        if integral:
+            station_df[c] = station_df[c].astype("int64")
+    return station_df
+
+
+def apply_changes(df, value_columns, change_rate, rng):
+    # A reload of the same file where change_rate of the rows have one value revised
+    changed_df = df.copy()
+    changed_rows = np.flatnonzero(rng.random(len(df)) < change_rate)
+    changed_columns = rng.choice(value_columns, len(changed_rows))
+    for c in value_columns:
+        rows = changed_rows[changed_columns == c]
+        integral = get_column_dtype(c) == INTEGER_DTYPE
+        step = np.where(rng.random(len(rows)) < 0.5, -1, 1) * (1 if integral else 0.1)
+        values = perturb(df[c].to_numpy(dtype="float64")[rows], step, integral)
+        changed_df.loc[changed_df.index[rows], c] = values.astype("int64") if integral else values
+    return changed_df, len(changed_rows)
+
+
+def generate_year(template, stations, year, seed):
+    year_rng = np.random.default_rng([seed, year])
+    value_columns = get_value_columns(template)
+    return pd.concat([generate_station(template, value_columns, i, year_rng, seed) for i in range(stations)],
+                     ignore_index=True)
+
+
+def write_csv(df, path):
+    # Quoted like the NOAA exports
+    df.to_csv(path, index=False, quoting=csv.QUOTE_ALL)
+
+
+def generate_dataset(template_path, output_dir, stations, years, change_rate, seed=0):
+    # Writes normal_hly_<year>.csv and normal_hly_<year>_reload.csv for each year. Returns
+    # [(year, csv_path, reload_path, changed_rows)].
+    template = read_template(template_path)
+    value_columns = get_value_columns(template)
+    pathlib.Path(output_dir).mkdir(parents=True, exist_ok=True)
+    files = []
+    for year in years:
+        year_df = generate_year(template, stations, year, seed)
+        reload_df, changed_rows = apply_changes(year_df, value_columns, change_rate,
+                                                np.random.default_rng([seed, year, 1]))
+        csv_path = pathlib.Path(output_dir, f"normal_hly_{year}.csv")
+        reload_path = pathlib.Path(output_dir, f"normal_hly_{year}_reload.csv")
+        write_csv(year_df, csv_path)
+        write_csv(reload_df, reload_path)
+        files.append((year, csv_path, reload_path, changed_rows))
+    return files
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate synthetic NORMAL_HLY CSVs from the sample station")
+    parser.add_argument("-i", "--input_path", help="template CSV", default="test_data/3033900.csv")
+    parser.add_argument("-o", "--output_location", default="benchmark_data")
+    parser.add_argument("-s", "--stations", default=10, type=int)
+    parser.add_argument("-y", "--years", help="years to generate", nargs="+", default=[2010], type=int)
+    parser.add_argument("--change_rate", help="fraction of rows revised in the reload files", default=0.01,
+                        type=float)
+    parser.add_argument("--seed", default=0, type=int)
+    args = parser.parse_args()
+    for year, csv_path, reload_path, changed_rows in generate_dataset(
+            args.input_path, args.output_location, args.stations, args.years, args.change_rate, args.seed):
+        print(f"{year}: {csv_path}, {reload_path} ({changed_rows} changed rows)")
@@ -1,7 +1,16 @@
-from noaa_etls.etls.csv_load import load_csv
-from noaa_etls.etls.staging_upsert import run_upsert
+from noaa_etls.etls.csv_load import load_csv, load_csv_batch, DEFAULT_SPLIT_WORKERS, DEFAULT_DB_WORKERS
+from noaa_etls.etls.api_load import load_api, DEFAULT_API_BATCH_SIZE, DEFAULT_START_DATE, DEFAULT_END_DATE
+from noaa_etls.etls.staging_upsert import run_upsert, detach_year_partition, DEFAULT_UPSERT_WORKERS, \
+    DEFAULT_UPSERT_ENGINE, UPSERT_ENGINES, UPSERT_CATEGORIES, UPSERT_BATCH_SIZES
+from noaa_etls.lib.noaa_db_lib import create_db_engine, DEFAULT_COPY_BATCH_SIZE, DEFAULT_POOL_SIZE, \
+    DEFAULT_MAX_OVERFLOW, DEFAULT_POOL_TIMEOUT, SESSION_PROFILES
+from noaa_etls.lib.noaa_csv_lib import DEFAULT_CHUNK_SIZE
+from noaa_etls.lib.noaa_pipeline_lib import DEFAULT_QUEUE_SIZE
+from noaa_etls.lib.noaa_dataset_lib import DEFAULT_ROW_GROUP_SIZE, DEFAULT_COMPRESSION
+from noaa_etls.lib.noaa_trace_lib import configure_tracing, close_tracing, span
 from initial_db_setup import init_db
 import argparse
+import os
 import sys
 import logging
 
@@ -12,57 +21,187 @@ logging.basicConfig(
 logger = logging.getLogger("noaa_entry_point")
 
 
-def build_db_uri(args):
-    return f"postgresql://{args.username}:{args.password}@{args.host}:{args.port}/{args.database}"
-
-
-def execute_init_db(_args):
+def build_db_uri(args, database=None):
+    return f"postgresql://{args.username}:{args.password}@{args.host}:{args.port}/{database or args.database}"
+
+
+def build_db_engine(args, pool_size=DEFAULT_POOL_SIZE, max_overflow=DEFAULT_MAX_OVERFLOW, database=None,
+                    isolation_level=None):
+    # Pool arguments left unset on the command line fall back to what the subcommand asks for
+    return create_db_engine(
+        build_db_uri(args, database),
+        args.session_profile,
+        pool_size=args.pool_size if args.pool_size is not None else pool_size,
+        max_overflow=args.max_overflow if args.max_overflow is not None else max_overflow,
+        pool_timeout=args.pool_timeout,
+        statement_timeout=args.statement_timeout,
+        isolation_level=isolation_level
+    )
+
+
+def add_db_args(parser, session_profile):
+    parser.add_argument("-u", "--username", help="db user name", default="noaa_etl")
+    parser.add_argument("-P", "--password", help="db password", default="secret")
+    parser.add_argument("-H", "--host", help="db host", default="localhost")
+    parser.add_argument("-p", "--port", help="db port", default="5432")
+    parser.add_argument("-d", "--database", help="db to connect to", default="noaa_etl")
+    parser.add_argument("--pool_size", help="connections kept open in the pool", type=int)
+    parser.add_argument("--max_overflow", help="connections opened beyond pool_size when busy", type=int)
+    parser.add_argument("--pool_timeout", help="seconds to wait for a free connection before failing", type=float,
+                        default=DEFAULT_POOL_TIMEOUT)
+    parser.add_argument("--statement_timeout", help="postgres statement_timeout for every session, e.g. 30min")
+    parser.add_argument("--session_profile", help="postgres session settings to connect with",
+                        choices=sorted(SESSION_PROFILES), default=session_profile)
+
+
+def execute_init_db(args):
     logger.info("Initializing DB")
-    init_db()
+    db_conn = build_db_engine(args, isolation_level="AUTOCOMMIT")
+    admin_db_conn = build_db_engine(args, pool_size=1, database="postgres", isolation_level="AUTOCOMMIT")
+    init_db(db_conn, admin_db_conn, args.concurrently, args.brin, args.explain, args.partition,
+            args.station_subpartitions)
 
 
 def execute_load_csv(args):
     logger.info("loading_csv")
-    db_uri = build_db_uri(args)
-    load_csv(args.input_path, args.output_location, db_uri, args.year)
+    db_conn = build_db_engine(args)
+    load_csv(args.input_path, args.output_location, db_conn, args.year, args.batch_size, args.chunk_size, args.force,
+             args.dataset, args.overwrite, args.row_group_size, args.compression, args.direct, args.queue_size)
+
+
+def execute_load_csv_batch(args):
+    logger.info("loading csv batch")
+    # Bounded pool: the DB stage never holds more connections than it has workers
+    db_conn = build_db_engine(args, pool_size=args.db_workers, max_overflow=0)
+    failures = load_csv_batch(args.input_path, args.output_location, db_conn, args.year, args.workers,
+                              args.db_workers, args.batch_size, args.chunk_size)
+    if failures:
+        sys.exit(1)
+
+
+def execute_load_api(args):
+    logger.info("loading from NOAA API")
+    db_conn = build_db_engine(args)
+    load_api(args.station_ids, db_conn, args.startdate, args.enddate, api_batch_size=args.api_batch_size,
+             batch_size=args.batch_size)
 
 
 def execute_upsert(args):
     logger.info("Upserting staging data")
-    db_uri = build_db_uri(args)
-    run_upsert(db_uri)
+    db_conn = build_db_engine(args, pool_size=args.workers)
+    run_upsert(db_conn, args.workers, args.engine, args.batch_by, args.batch_size)
+
+
+def execute_detach_partition(args):
+    logger.info(f"Detaching {args.year} partitions")
+    db_conn = build_db_engine(args)
+    for category in UPSERT_CATEGORIES.values():
+        detach_year_partition(db_conn, category["final_table"], args.year)
 
 
 def parse_args(args):
 
     parser = argparse.ArgumentParser(description="NOAA Hourly data ETL")
+    parser.add_argument("--trace_jsonl", help="append a JSON line per stage and SQL statement span to this file",
+                        default=os.environ.get("NOAA_TRACE_JSONL"))
+    parser.add_argument("--prom_textfile", help="write span totals to this Prometheus textfile on exit",
+                        default=os.environ.get("NOAA_TRACE_PROM"))
     subparsers = parser.add_subparsers()
 
     init_db_parser = subparsers.add_parser("init_db", help="initialize database")
+    init_db_parser.add_argument("--concurrently", help="build missing indexes CONCURRENTLY", action="store_true")
+    init_db_parser.add_argument("--brin", help="add BRIN indexes on date_time", action="store_true")
+    init_db_parser.add_argument("--explain", help="check the upsert query plans use the indexes",
+                                action="store_true")
+    init_db_parser.add_argument("--partition", help="range partition new hourly tables by year of date_time",
+                                action="store_true")
+    init_db_parser.add_argument("--station_subpartitions", help="list sub-partition each year by station",
+                                action="store_true")
+    add_db_args(init_db_parser, "maintenance")
     init_db_parser.set_defaults(func=execute_init_db)
 
     load_csv_parser = subparsers.add_parser("load_csv", help="Load CSV data into staging")
     load_csv_parser.add_argument("-i", "--input_path")
     load_csv_parser.add_argument("-o", "--output_location")
-    load_csv_parser.add_argument("-u", "--username", help="db user name", default="noaa_etl")
-    load_csv_parser.add_argument("-P", "--password", help="db password", default="secret")
-    load_csv_parser.add_argument("-H", "--host", help="db host", default="localhost")
-    load_csv_parser.add_argument("-p", "--port", help="db port", default="5432")
-    load_csv_parser.add_argument("-d", "--database", help="db to connect to", default="noaa_etl")
+    add_db_args(load_csv_parser, "bulk")
     load_csv_parser.add_argument("-y", "--year", help="year csv covers", default=2010)
+    load_csv_parser.add_argument("-b", "--batch_size", help="rows per COPY batch into staging", type=int,
+                                 default=DEFAULT_COPY_BATCH_SIZE)
+    load_csv_parser.add_argument("-c", "--chunk_size", help="rows per streamed CSV chunk", type=int,
+                                 default=DEFAULT_CHUNK_SIZE)
+    load_csv_parser.add_argument("--force", help="load even if the load manifest has this file already",
+                                 action="store_true")
+    load_csv_modes = load_csv_parser.add_mutually_exclusive_group()
+    load_csv_modes.add_argument("--dataset", help="write into a year/station partitioned dataset at output_location",
+                                action="store_true")
+    load_csv_modes.add_argument("--direct", help="stream parsed chunks straight into staging. output_location is "
+                                                 "optional and keeps the split parquet files as an archive",
+                                action="store_true")
+    load_csv_parser.add_argument("--queue_size", help="chunks buffered between the --direct stages", type=int,
+                                 default=DEFAULT_QUEUE_SIZE)
+    load_csv_parser.add_argument("--overwrite", help="replace dataset partitions instead of appending to them",
+                                 action="store_true")
+    load_csv_parser.add_argument("--row_group_size", help="rows per parquet row group in the dataset", type=int,
+                                 default=DEFAULT_ROW_GROUP_SIZE)
+    load_csv_parser.add_argument("--compression", help="parquet compression codec for the dataset",
+                                 default=DEFAULT_COMPRESSION)
     load_csv_parser.set_defaults(func=execute_load_csv)
 
+    load_csv_batch_parser = subparsers.add_parser("load_csv_batch", help="Load many CSVs into staging in parallel")
+    load_csv_batch_parser.add_argument("-i", "--input_path", help="directory, glob or manifest of CSV paths")
+    load_csv_batch_parser.add_argument("-o", "--output_location", help="directory for the split files, batch state and "
+                                                                  "failed file list", required=True)
+    add_db_args(load_csv_batch_parser, "bulk")
+    load_csv_batch_parser.add_argument("-y", "--year", help="year the csvs cover", default=2010)
+    load_csv_batch_parser.add_argument("-w", "--workers", help="processes parsing and splitting CSVs", type=int,
+                                       default=DEFAULT_SPLIT_WORKERS)
+    load_csv_batch_parser.add_argument("--db_workers", help="concurrent loads into staging", type=int,
+                                       default=DEFAULT_DB_WORKERS)
+    load_csv_batch_parser.add_argument("-b", "--batch_size", help="rows per COPY batch into staging", type=int,
+                                       default=DEFAULT_COPY_BATCH_SIZE)
+    load_csv_batch_parser.add_argument("-c", "--chunk_size", help="rows per streamed CSV chunk", type=int,
+                                       default=DEFAULT_CHUNK_SIZE)
+    load_csv_batch_parser.set_defaults(func=execute_load_csv_batch)
+
+    load_api_parser = subparsers.add_parser("load_api", help="Load NORMAL_HLY data from the NOAA API into staging")
+    load_api_parser.add_argument("-s", "--station_ids", help="CDO station ids, e.g. GHCND:USW00023036", nargs="+",
+                                 required=True)
+    load_api_parser.add_argument("--startdate", default=DEFAULT_START_DATE)
+    load_api_parser.add_argument("--enddate", default=DEFAULT_END_DATE)
+    add_db_args(load_api_parser, "bulk")
+    load_api_parser.add_argument("--api_batch_size", help="API records pivoted per staging batch", type=int,
+                                 default=DEFAULT_API_BATCH_SIZE)
+    load_api_parser.add_argument("-b", "--batch_size", help="rows per COPY batch into staging", type=int,
+                                 default=DEFAULT_COPY_BATCH_SIZE)
+    load_api_parser.set_defaults(func=execute_load_api)
+
     upsert_staging_parser = subparsers.add_parser("upsert_staging_data", help="Upsert staging_data")
-    upsert_staging_parser.add_argument("-u", "--username", help="db user name", default="noaa_etl")
-    upsert_staging_parser.add_argument("-P", "--password", help="db password", default="secret")
-    upsert_staging_parser.add_argument("-H", "--host", help="db host", default="localhost")
-    upsert_staging_parser.add_argument("-p", "--port", help="db port", default="54323")
-    upsert_staging_parser.add_argument("-d", "--database", help="db to connect to", default="noaa_etl")
+    add_db_args(upsert_staging_parser, "upsert")
+    upsert_staging_parser.add_argument("-w", "--workers", help="categories to upsert in parallel", type=int,
+                                       default=DEFAULT_UPSERT_WORKERS)
+    upsert_staging_parser.add_argument("-e", "--engine", help="upsert strategy for the hourly tables",
+                                       choices=sorted(UPSERT_ENGINES), default=DEFAULT_UPSERT_ENGINE)
+    upsert_staging_parser.add_argument("--batch_by", help="commit the upsert in batches of stations or date windows, "
+                                                          "resuming from the last committed batch after a failure",
+                                       choices=sorted(UPSERT_BATCH_SIZES))
+    upsert_staging_parser.add_argument("--batch_size", help="stations or days per batch, "
+                                                            f"{UPSERT_BATCH_SIZES['station']} stations or "
+                                                            f"{UPSERT_BATCH_SIZES['date']} days by default", type=int)
     upsert_staging_parser.set_defaults(func=execute_upsert)
 
+    detach_parser = subparsers.add_parser("detach_partition", help="detach a year from the partitioned hourly tables")
+    detach_parser.add_argument("-y", "--year", help="year to detach", type=int, required=True)
+    add_db_args(detach_parser, "default")
+    detach_parser.set_defaults(func=execute_detach_partition)
+
     return parser.parse_args(args)
 
 
 if __name__ == "__main__":
     parsed_args = parse_args(sys.argv[1:])
-    parsed_args.func(parsed_args)
+    configure_tracing(parsed_args.trace_jsonl, parsed_args.prom_textfile)
+    try:
+        with span(parsed_args.func.__name__.replace("execute_", "")):
+            parsed_args.func(parsed_args)
+    finally:
+        close_tracing()
@@ -1 +1,146 @@
-import noaa_etls.lib.noaa_api_lib
\ No newline at end of file
+from noaa_etls.lib.noaa_api_lib import iter_data, get_station, DEFAULT_PREFETCH_PAGES
+from noaa_etls.lib.noaa_csv_lib import col_translator, get_raw_dtypes
+from noaa_etls.lib.noaa_db_lib import DEFAULT_COPY_BATCH_SIZE
+from noaa_etls.lib.noaa_completeness_lib import CompletenessCache
+from noaa_etls.etls.raw_to_staging import CATEGORY_EXTRACTORS, extract_category, stage_df, get_previous_load_time, \
+    analyze_staging_tables
+from noaa_etls.lib.noaa_categories import CATEGORIES
+from noaa_etls.lib.noaa_trace_lib import traced, current_span
+from sqlalchemy import inspect
+import sys
+import logging
+import datetime
+import pandas
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_api_to_staging")
+
+NORMAL_HLY_DATASET = "NORMAL_HLY"
+DEFAULT_API_BATCH_SIZE = 20000
+DEFAULT_START_DATE = "2010-01-01"
+DEFAULT_END_DATE = "2010-12-31"
+
+
+def strip_station_prefix(stationid):
+    # The API prefixes station ids with their network ("GHCND:USW00023036"), the CSV exports do not
+    return stationid.split(":")[-1]
+
+
+def get_api_load_path(datasetid, stationid, startdate, enddate):
+    return f"api:{datasetid}:{stationid}:{startdate}:{enddate}"
+
+
+def get_station_df(stationid):
+    station = get_station(stationid)
+    return pandas.DataFrame([{
+        "station": strip_station_prefix(stationid),
+        "name": station.get("name"),
+        "latitude": station.get("latitude"),
+        "longitude": station.get("longitude"),
+        "elevation": station.get("elevation")
+    }])
+
+
+def pivot_records(records):
+    # Long API records (one per datatype) become the same wide, renamed frame load_csv_raw produces
+    long_df = pandas.DataFrame.from_records(records, columns=["station", "date", "datatype", "value", "attributes"])
+    long_df["station"] = long_df["station"].map(strip_station_prefix)
+    values = long_df.pivot(index=["station", "date"], columns="datatype", values="value")
+    attributes = long_df.pivot(index=["station", "date"], columns="datatype", values="attributes")
+    wide_df = pandas.concat([values, attributes.add_suffix("_ATTRIBUTES")], axis=1).reset_index()
+    wide_df = wide_df.astype(get_raw_dtypes(wide_df.columns))
+
+    wide_df.columns = [col_translator(c) for c in wide_df.columns]
+    wide_df = wide_df.rename(columns={"date": "date_time"})
+    wide_df["date_time"] = pandas.to_datetime(wide_df["date_time"], format="%Y-%m-%dT%H:%M:%S")
+    return wide_df
+
+
+def complete_category_columns(wide_df):
+    # A batch only has the datatypes the API returned for it, so fill the rest in as missing
+    missing = {}
+    for category in CATEGORIES.values():
+        for c in category["columns"]:
+            for column in [c, f"{c}_completeness"]:
+                if column not in wide_df.columns and column not in missing:
+                    missing[column] = None
+    if missing:
+        wide_df = wide_df.assign(**missing)
+    return wide_df
+
+
+def split_complete_records(records):
+    # Records come sorted by date, and the last date in a page may continue on the next one.
+    # Hold that date back so each (station, date) row is staged whole.
+    last_date = records[-1]["date"]
+    split = len(records)
+    while split > 0 and records[split - 1]["date"] == last_date:
+        split -= 1
+    return records[:split], records[split:]
+
+
+def stage_records(db_conn, records, load_path, load_time, batch_size, completeness_cache):
+    wide_df = complete_category_columns(pivot_records(records))
+    rows = 0
+    for category in CATEGORY_EXTRACTORS:
+        rows += stage_df(db_conn, extract_category(wide_df, category), category, load_path, load_time, batch_size,
+                         completeness_cache, analyze=False)
+    return rows
+
+
+def clear_partial_load(db_conn, load_path):
+    # A run that died mid stream leaves category rows without a stations row. Drop them before reloading.
+    for category in CATEGORY_EXTRACTORS:
+        table_name = f"{category}_staging"
+        if inspect(db_conn).has_table(table_name):
+            db_conn.execute(f"delete from {table_name} where load_path = '{load_path}';")
+
+
+@traced
+def load_api_station(db_conn, stationid, startdate=DEFAULT_START_DATE, enddate=DEFAULT_END_DATE,
+                     datasetid=NORMAL_HLY_DATASET, api_batch_size=DEFAULT_API_BATCH_SIZE,
+                     batch_size=DEFAULT_COPY_BATCH_SIZE, prefetch=DEFAULT_PREFETCH_PAGES, completeness_cache=None):
+    load_path = get_api_load_path(datasetid, stationid, startdate, enddate)
+    # The stations row is staged last, so it only exists once every category made it in
+    prev_loads = get_previous_load_time(db_conn, "stations_staging", load_path)
+    if prev_loads:
+        logger.info(f"Previous load found from {prev_loads}. Skipping load to staging.")
+        return 0
+    clear_partial_load(db_conn, load_path)
+
+    if completeness_cache is None:
+        completeness_cache = CompletenessCache(db_conn)
+    load_time = datetime.datetime.now()
+    rows = 0
+    pending = []
+    # iter_data keeps fetching the next pages in the background while a batch is pivoted and copied
+    for record in iter_data(datasetid=datasetid, stationid=stationid, startdate=startdate, enddate=enddate,
+                            sortfield="date", prefetch=prefetch):
+        pending.append(record)
+        if len(pending) >= api_batch_size:
+            complete, pending = split_complete_records(pending)
+            if complete:
+                rows += stage_records(db_conn, complete, load_path, load_time, batch_size, completeness_cache)
+    if pending:
+        rows += stage_records(db_conn, pending, load_path, load_time, batch_size, completeness_cache)
+
+    stage_df(db_conn, get_station_df(stationid), "stations", load_path, load_time, batch_size, analyze=False)
+    logger.info(f"Staged {rows} rows for {stationid}")
+    current_span().set(station=stationid, rows=rows)
+    return rows
+
+
+def load_api(stationids, db_conn, startdate=DEFAULT_START_DATE, enddate=DEFAULT_END_DATE,
+             datasetid=NORMAL_HLY_DATASET, api_batch_size=DEFAULT_API_BATCH_SIZE, batch_size=DEFAULT_COPY_BATCH_SIZE):
+    completeness_cache = CompletenessCache(db_conn)
+    rows = 0
+    for stationid in stationids:
+        rows += load_api_station(db_conn, stationid, startdate, enddate, datasetid, api_batch_size, batch_size,
+                                 completeness_cache=completeness_cache)
+    # Staged in many small batches, so statistics are gathered once at the end
+    if rows:
+        analyze_staging_tables(db_conn)
+    return rows
@@ -1,16 +1,185 @@
-from noaa_etls.etls.raw_to_staging import split_hourly_data_into_categories, raw_split_file_to_db
-from noaa_etls.lib.noaa_csv_lib import load_csv_raw
-from sqlalchemy import create_engine
+from noaa_etls.etls.raw_to_staging import split_hourly_data_into_categories, raw_split_file_to_db, \
+    split_hourly_data_into_dataset, raw_dataset_to_db, stream_hourly_data_to_db, analyze_staging_tables, \
+    prepare_staging_tables
+from noaa_etls.lib.noaa_csv_lib import iter_csv_raw, DEFAULT_CHUNK_SIZE
+from noaa_etls.lib.noaa_db_lib import DEFAULT_COPY_BATCH_SIZE
+from noaa_etls.lib.noaa_dataset_lib import DEFAULT_ROW_GROUP_SIZE, DEFAULT_COMPRESSION
+from noaa_etls.lib.noaa_pipeline_lib import DEFAULT_QUEUE_SIZE
+from noaa_etls.lib.noaa_trace_lib import traced, current_span, in_current_span
+from noaa_etls.lib.noaa_completeness_lib import CompletenessCache
+from noaa_etls.lib.noaa_manifest_lib import create_load_manifest_table, fingerprint_file, record_load, refresh_stat, \
+    stat_file, hash_file
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import os
+import glob
+import hashlib
+import json
+import time
+import pathlib
 import logging
 
 logger = logging.getLogger("noaa_csv_to_staging")
 
+DEFAULT_SPLIT_WORKERS = os.cpu_count() or 1
+DEFAULT_DB_WORKERS = 4
+RUN_ID_LENGTH = 16
+BATCH_STATE_FILE = "batch_state.json"
+BATCH_FAILURES_FILE = "failed_files.txt"
+BATCH_SPLIT_HASH_LENGTH = 8
 
-def load_csv(csv_path, output_path, db_conn_uri, year):
-    db_conn = create_engine(db_conn_uri)
-    main_df = load_csv_raw(csv_path, year)
-    split_hourly_data_into_categories(main_df, output_path)
-    raw_split_file_to_db(db_conn, output_path)
 
+def get_run_id(content_hash, year):
+    return hashlib.sha256(f"{content_hash}:{int(year)}".encode()).hexdigest()[:RUN_ID_LENGTH]
 
 
+@traced
+def load_csv(csv_path, output_path, db_conn, year, batch_size=DEFAULT_COPY_BATCH_SIZE,
+             chunk_size=DEFAULT_CHUNK_SIZE, force=False, dataset=False, overwrite=False,
+             row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION, direct=False,
+             queue_size=DEFAULT_QUEUE_SIZE):
+    current_span().set(csv_path=str(csv_path), bytes_read=os.path.getsize(csv_path))
+    create_load_manifest_table(db_conn)
+    # Unchanged inputs cost a stat, or a hash when the stat moved, instead of a parse and upload
+    if force:
+        fingerprint = (*stat_file(csv_path), hash_file(csv_path))
+    else:
+        prev_load, fingerprint = fingerprint_file(db_conn, csv_path, year)
+        if prev_load is not None:
+            logger.info(f"{csv_path} was already loaded for {year} to {prev_load[1]} at {prev_load[2]}. "
+                        f"Skipping load.")
+            refresh_stat(db_conn, csv_path, year, fingerprint)
+            return 0
+
+    main_chunks = iter_csv_raw(csv_path, year, chunk_size)
+    if direct:
+        # Straight from parsed chunks to staging. output_path, when given, still gets the split files as an archive.
+        load_path = output_path or os.path.abspath(csv_path)
+        rows_loaded = stream_hourly_data_to_db(db_conn, main_chunks, load_path, output_path, batch_size, queue_size)
+        output_path = load_path
+    elif dataset:
+        # output_path is the root of a partitioned dataset shared by every run, files are named after the content
+        # and the year it was loaded for
+        run_id = get_run_id(fingerprint[2], year)
+        split_hourly_data_into_dataset(main_chunks, output_path, run_id, overwrite, row_group_size, compression)
+        rows_loaded = raw_dataset_to_db(db_conn, output_path, run_id, batch_size=batch_size)
+    else:
+        split_hourly_data_into_categories(main_chunks, output_path)
+        rows_loaded = raw_split_file_to_db(db_conn, output_path, batch_size)
+    record_load(db_conn, csv_path, year, fingerprint, output_path, rows_loaded)
+    current_span().set(rows=rows_loaded)
+    return rows_loaded
+
+
+def read_manifest(manifest_path):
+    # One CSV path per line, relative paths are relative to the manifest. Blank lines and # comments are ignored.
+    manifest_dir = pathlib.Path(manifest_path).parent
+    with open(manifest_path) as manifest:
+        lines = [line.strip() for line in manifest]
+    return [manifest_dir.joinpath(line) for line in lines if line and not line.startswith("#")]
+
+
+def resolve_input_paths(input_spec):
+    input_path = pathlib.Path(input_spec)
+    if input_path.is_dir():
+        return sorted(input_path.glob("*.csv"))
+    if input_path.is_file():
+        return [input_path] if input_path.suffix.lower() == ".csv" else read_manifest(input_path)
+    return sorted(pathlib.Path(p) for p in glob.glob(input_spec))
+
+
+def read_batch_state(state_path):
+    if not state_path.exists():
+        return {}
+    with open(state_path) as state_file:
+        return json.load(state_file)
+
+
+def write_batch_state(state_path, state):
+    tmp_path = state_path.with_suffix(".tmp")
+    with open(tmp_path, "w") as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def get_batch_split_path(output_location, csv_path):
+    # Files with the same name from different folders each get their own split directory
+    path_hash = hashlib.sha256(os.path.abspath(csv_path).encode()).hexdigest()[:BATCH_SPLIT_HASH_LENGTH]
+    return str(pathlib.Path(output_location, f"{pathlib.Path(csv_path).stem}-{path_hash}"))
+
+
+def split_csv_file(csv_path, output_path, year, chunk_size):
+    # Runs in a worker process, so it only touches local files
+    split_hourly_data_into_categories(iter_csv_raw(csv_path, year, chunk_size), output_path)
+    return os.path.getsize(csv_path)
+
+
+def log_batch_progress(done, total, failed, rows, csv_bytes, start_time):
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"{done}/{total} files loaded, {failed} failed, {rows} rows, "
+                f"{csv_bytes / elapsed / 1e6:.2f} MB/s, {rows / elapsed:,.0f} rows/s")
+
+
+@traced
+def load_csv_batch(input_spec, output_location, db_conn, year, workers=DEFAULT_SPLIT_WORKERS,
+                   db_workers=DEFAULT_DB_WORKERS, batch_size=DEFAULT_COPY_BATCH_SIZE, chunk_size=DEFAULT_CHUNK_SIZE):
+    os.makedirs(output_location, exist_ok=True)
+    state_path = pathlib.Path(output_location, BATCH_STATE_FILE)
+    state = read_batch_state(state_path)
+
+    csv_paths = [str(p) for p in resolve_input_paths(input_spec)]
+    todo = [p for p in csv_paths if state.get(p) != "loaded"]
+    logger.info(f"{len(csv_paths)} files found, {len(csv_paths) - len(todo)} already loaded")
+
+    completeness_cache = CompletenessCache(db_conn)
+
+    start_time = time.perf_counter()
+    failures = {}
+    rows = 0
+    csv_bytes = 0
+    done = 0
+    with ProcessPoolExecutor(max_workers=workers) as split_pool, \
+            ThreadPoolExecutor(max_workers=db_workers) as db_pool:
+        split_futures = {
+            split_pool.submit(split_csv_file, p, get_batch_split_path(output_location, p), year, chunk_size): p
+            for p in todo
+        }
+        db_futures = {}
+        for future in as_completed(split_futures):
+            csv_path = split_futures[future]
+            try:
+                csv_bytes += future.result()
+            except Exception as e:
+                logger.exception(f"Failed to split {csv_path}")
+                failures[csv_path] = repr(e)
+                continue
+            output_path = get_batch_split_path(output_location, csv_path)
+            if not db_futures:
+                prepare_staging_tables(db_conn, output_path)
+            # Statistics are gathered once after the whole batch rather than after every file
+            db_futures[db_pool.submit(in_current_span(raw_split_file_to_db), db_conn, output_path, batch_size,
+                                      completeness_cache, False)] = csv_path
+
+        for future in as_completed(db_futures):
+            csv_path = db_futures[future]
+            try:
+                rows += future.result()
+            except Exception as e:
+                logger.exception(f"Failed to load {csv_path} to staging")
+                failures[csv_path] = repr(e)
+                continue
+            done += 1
+            state[csv_path] = "loaded"
+            write_batch_state(state_path, state)
+            log_batch_progress(done, len(todo), len(failures), rows, csv_bytes, start_time)
+
+    if done:
+        analyze_staging_tables(db_conn)
+
+    # The failure list doubles as a manifest, so a retry is `load_csv_batch -i <output>/failed_files.txt`
+    failures_path = pathlib.Path(output_location, BATCH_FAILURES_FILE)
+    with open(failures_path, "w") as failures_file:
+        failures_file.writelines(f"{os.path.abspath(p)}\n" for p in failures)
+    log_batch_progress(done, len(todo), len(failures), rows, csv_bytes, start_time)
+    if failures:
+        logger.error(f"{len(failures)} files failed. Retry them with -i {failures_path}")
+    return failures
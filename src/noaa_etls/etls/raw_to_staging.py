@@ -1,10 +1,28 @@
 import os
 import sys
+import queue
 import pathlib
 import logging
 import datetime
+import threading
+import numpy
 import pandas
+import pyarrow
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 from sqlalchemy import inspect
+from concurrent.futures import ThreadPoolExecutor
+from noaa_etls.lib.noaa_db_lib import copy_dfs_to_table, analyze_table, create_table_from_df, \
+    DEFAULT_COPY_BATCH_SIZE
+from noaa_etls.lib.noaa_completeness_lib import CompletenessCache
+from noaa_etls.lib.noaa_csv_lib import VALUE_DTYPE
+from noaa_etls.lib.noaa_categories import CATEGORIES, STATION_COLUMNS, get_category_columns, \
+    get_completeness_columns
+from noaa_etls.lib.noaa_trace_lib import traced, current_span, in_current_span
+from noaa_etls.lib.noaa_pipeline_lib import put_item, iter_queue, fill_queue, run_stage, get_stage_results, \
+    QUEUE_END, DEFAULT_QUEUE_SIZE
+from noaa_etls.lib.noaa_dataset_lib import PartitionedDatasetWriter, open_category_dataset, partition_filter, \
+    CATEGORY_PARTITIONING, STATION_PARTITIONING, DEFAULT_ROW_GROUP_SIZE, DEFAULT_COMPRESSION, DEFAULT_FLUSH_ROWS
 
 logging.basicConfig(
     level=logging.INFO,
@@ -12,145 +30,443 @@ logging.basicConfig(
 )
 logger = logging.getLogger("noaa_raw_to_staging")
 
+# Columns added to category staging tables after they were first created by older loads
+STAGING_EXTRA_COLUMNS = {"data_completeness_id": "integer", "row_hash": "bigint"}
+
+
+def first_station_rows(stations):
+    return numpy.flatnonzero(~stations.duplicated().to_numpy())
+
 
 def extract_station_info(main_df):
-    columns_to_extract = [
-        "station",
-        "name",
-        "latitude",
-        "longitude",
-        "elevation"
-    ]
-    station_df = main_df[columns_to_extract].drop_duplicates()
-    return station_df
+    # Station metadata is constant per station, so keep the first row of each instead of comparing whole rows
+    if isinstance(main_df, pyarrow.Table):
+        return main_df.take(first_station_rows(main_df["station"].to_pandas())).select(STATION_COLUMNS)
+    return main_df.loc[~main_df["station"].duplicated(), STATION_COLUMNS]
+
+
+def select_category(main_df, category):
+    # A column selection on an Arrow table shares the parent's buffers, on a DataFrame it copies
+    columns = get_category_columns(category)
+    if isinstance(main_df, pyarrow.Table):
+        return main_df.select(columns)
+    return main_df[columns]
 
 
 def extract_temperature_df(main_df):
-    columns_to_extract = [
-        "station",
-        "date_time",
-        "hourly_temperature_tenth_percentile",
-        "hourly_temperature_tenth_percentile_completeness",
-        "hourly_temperature_ninetieth_percentile",
-        "hourly_temperature_ninetieth_percentile_completeness",
-        "hourly_temperature_mean",
-        "hourly_temperature_mean_completeness",
-        "hourly_cooling_degree_hours_mean",
-        "hourly_cooling_degree_hours_mean_completeness",
-        "hourly_heating_degree_hours_mean",
-        "hourly_heating_degree_hours_mean_completeness",
-        "hourly_heat_index_mean",
-        "hourly_heat_index_mean_completeness"
-    ]
-    temperature_df = main_df[columns_to_extract]
-    return temperature_df
+    return select_category(main_df, "temp")
 
 
 def extract_dewpoint_df(main_df):
-    columns_to_extract = [
-        "station",
-        "date_time",
-        "hourly_dew_point_tenth_percentile",
-        "hourly_dew_point_tenth_percentile_completeness",
-        "hourly_dew_point_ninetieth_percentile",
-        "hourly_dew_point_ninetieth_percentile_completeness",
-        "hourly_dew_point_mean",
-        "hourly_dew_point_mean_completeness"
-    ]
-    dewpoint_df = main_df[columns_to_extract]
-    return dewpoint_df
+    return select_category(main_df, "dewpt")
 
 
 def extract_pressure_df(main_df):
-    columns_to_extract = [
-        "station",
-        "date_time",
-        "hourly_sea_level_pressure_tenth_percentile",
-        "hourly_sea_level_pressure_tenth_percentile_completeness",
-        "hourly_sea_level_pressure_ninetieth_percentile",
-        "hourly_sea_level_pressure_ninetieth_percentile_completeness",
-        "hourly_sea_level_pressure_mean",
-        "hourly_sea_level_pressure_mean_completeness"
-    ]
-    pressure_df = main_df[columns_to_extract]
-    return pressure_df
+    return select_category(main_df, "pressure")
 
 
 def extract_wind_df(main_df):
-    columns_to_extract = [
-        "station",
-        "date_time",
-        "hourly_wind_chill_mean",
-        "hourly_wind_chill_mean_completeness",
-        "hourly_wind_prevailing_direction",
-        "hourly_wind_prevailing_direction_completeness",
-        "hourly_wind_prevailing_percentage",
-        "hourly_wind_prevailing_percentage_completeness",
-        "hourly_wind_secondary_direction",
-        "hourly_wind_secondary_direction_completeness",
-        "hourly_wind_secondary_percentage",
-        "hourly_wind_secondary_percentage_completeness",
-        "hourly_wind_average_speed",
-        "hourly_wind_average_speed_completeness",
-        "hourly_wind_percentage_calm",
-        "hourly_wind_percentage_calm_completeness",
-        "hourly_wind_mean_vector_direction",
-        "hourly_wind_mean_vector_direction_completeness",
-        "hourly_wind_mean_vector_magnitude",
-        "hourly_wind_mean_vector_magnitude_completeness"
-    ]
-    wind_df = main_df[columns_to_extract]
-    return wind_df
+    return select_category(main_df, "wind")
+
+
+CATEGORY_EXTRACTORS = {
+    "temp": extract_temperature_df,
+    "dewpt": extract_dewpoint_df,
+    "pressure": extract_pressure_df,
+    "wind": extract_wind_df
+}
+
+
+def compute_row_hash(df, category):
+    # 64 bit hash of a row's values and completeness flags. Values and flags are normalised first so the CSV and
+    # API loaders hash the same reading the same way. Values are hashed at the real precision the DB keeps.
+    values = df[CATEGORIES[category]["columns"]].astype(VALUE_DTYPE)
+    flags = df[get_completeness_columns(category)].astype("object")
+    flags = flags.where(flags.notna(), "").astype(str)
+    hashes = pandas.util.hash_pandas_object(pandas.concat([values, flags], axis=1), index=False)
+    return pandas.Series(hashes.to_numpy().view("int64"), index=df.index)
+
+
+def extract_category(main_df, category):
+    category_df = CATEGORY_EXTRACTORS[category](main_df)
+    return category_df.assign(row_hash=compute_row_hash(category_df, category))
+
+
+def extract_category_table(chunk_table, chunk, category):
+    # chunk_table is the Arrow form of chunk. Only the hash is new memory, the columns are shared with chunk_table.
+    row_hash = pyarrow.array(compute_row_hash(chunk, category).to_numpy(), pyarrow.int64())
+    return CATEGORY_EXTRACTORS[category](chunk_table).append_column("row_hash", row_hash)
+
+
+def iter_chunk_tables(main_df):
+    # Accept either a single frame or an iterable of chunks from noaa_csv_lib.iter_csv_raw
+    chunks = [main_df] if isinstance(main_df, pandas.DataFrame) else main_df
+    for chunk in chunks:
+        yield chunk, pyarrow.Table.from_pandas(chunk, preserve_index=False)
+
+
+def get_split_file_path(output_path, name):
+    return pathlib.Path(output_path, name).with_suffix(".parquet")
+
+
+def get_split_temp_path(output_path, name):
+    # Split files are written under this name and only renamed to their final one once complete, so an interrupted
+    # split is redone rather than skipped as already written
+    return pathlib.Path(output_path, name).with_suffix(".parquet.tmp")
 
 
 def write_df(df, output_path):
-    if os.path.exists(output_path):
+    final_path = pathlib.Path(output_path).with_suffix(".parquet")
+    if final_path.exists():
         logger.info("Output already exists. Skipping write")
     else:
-        df.to_parquet(pathlib.Path(output_path).with_suffix(".parquet"))
+        temp_path = pathlib.Path(output_path).with_suffix(".parquet.tmp")
+        df.to_parquet(temp_path)
+        os.replace(temp_path, final_path)
 
 
+def write_chunk(writers, name, table, output_path):
+    # Later chunks are cast to the first chunk's schema
+    if name in writers:
+        table = table.cast(writers[name].schema)
+    else:
+        writers[name] = pq.ParquetWriter(str(get_split_temp_path(output_path, name)), table.schema)
+    writers[name].write_table(table)
+
+
+def close_writers(writers, output_path, completed):
+    # Completed files move to their final names, the partial files of a failed split are removed
+    for name, writer in writers.items():
+        writer.close()
+        temp_path = get_split_temp_path(output_path, name)
+        if completed:
+            os.replace(temp_path, get_split_file_path(output_path, name))
+        else:
+            temp_path.unlink(missing_ok=True)
+
+
+def dedupe_stations(station_tables):
+    return extract_station_info(pyarrow.concat_tables(station_tables)).to_pandas()
+
+
+@traced
 def split_hourly_data_into_categories(main_df, output_path):
     if not os.path.exists(output_path):
         os.makedirs(output_path)
-    station_df = extract_station_info(main_df)
-    temp_df = extract_temperature_df(main_df)
-    dewpt_df = extract_dewpoint_df(main_df)
-    pressure_df = extract_pressure_df(main_df)
-    wind_df = extract_wind_df(main_df)
 
-    write_df(station_df, str(pathlib.Path(output_path, "stations")))
-    write_df(temp_df, str(pathlib.Path(output_path, "temp")))
-    write_df(dewpt_df, str(pathlib.Path(output_path, "dewpt")))
-    write_df(pressure_df, str(pathlib.Path(output_path, "pressure")))
-    write_df(wind_df, str(pathlib.Path(output_path, "wind")))
+    to_write = []
+    for name in CATEGORY_EXTRACTORS:
+        if get_split_file_path(output_path, name).exists():
+            logger.info(f"Output already exists for {name}. Skipping write")
+        else:
+            to_write.append(name)
+    if not to_write and get_split_file_path(output_path, "stations").exists():
+        logger.info("All outputs already exist. Skipping split")
+        return
+
+    station_tables = []
+    writers = {}
+    rows = 0
+    completed = False
+    try:
+        for chunk, chunk_table in iter_chunk_tables(main_df):
+            rows += chunk_table.num_rows
+            station_tables.append(extract_station_info(chunk_table))
+            for name in to_write:
+                write_chunk(writers, name, extract_category_table(chunk_table, chunk, name), output_path)
+        completed = True
+    finally:
+        close_writers(writers, output_path, completed)
+
+    if station_tables:
+        write_df(dedupe_stations(station_tables), str(pathlib.Path(output_path, "stations")))
+    written = [get_split_file_path(output_path, name) for name in [*to_write, "stations"]]
+    current_span().set(rows=rows, bytes_written=sum(p.stat().st_size for p in written if p.exists()))
+
+
+@traced
+def split_hourly_data_into_dataset(main_df, dataset_root, run_id, overwrite=False,
+                                   row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION,
+                                   flush_rows=DEFAULT_FLUSH_ROWS):
+    # Same split as split_hourly_data_into_categories, but into one dataset for every run:
+    # <dataset_root>/category=<name>/year=<year>/station=<station>/<run_id>-*.parquet
+    writers = {
+        name: PartitionedDatasetWriter(
+            dataset_root, name, CATEGORY_PARTITIONING, run_id, overwrite, row_group_size, compression,
+            dictionary_columns=get_completeness_columns(name),
+            flush_rows=flush_rows
+        )
+        for name in CATEGORY_EXTRACTORS
+    }
+    station_tables = []
+    rows = 0
+    for chunk, chunk_table in iter_chunk_tables(main_df):
+        rows += chunk_table.num_rows
+        station_tables.append(extract_station_info(chunk_table))
+        year = pc.year(chunk_table["date_time"]).cast(pyarrow.int16())
+        for name, writer in writers.items():
+            writer.write(extract_category_table(chunk_table, chunk, name).append_column("year", year))
+
+    files = {name: writer.close() for name, writer in writers.items()}
+    if station_tables:
+        station_writer = PartitionedDatasetWriter(dataset_root, "stations", STATION_PARTITIONING, run_id, overwrite,
+                                                  row_group_size, compression, dictionary_columns=[])
+        station_writer.write(pyarrow.Table.from_pandas(dedupe_stations(station_tables), preserve_index=False))
+        files["stations"] = station_writer.close()
+    current_span().set(rows=rows, bytes_written=sum(os.path.getsize(f) for paths in files.values() for f in paths))
+    return files
 
 
 def get_raw_load_table_name(file):
     return f"{pathlib.Path(file).stem}_staging"
 
 
-def raw_split_file_to_db(db_conn, raw_split_out):
-    files = os.listdir(raw_split_out)
-    for f in files:
-        full_path = pathlib.Path(raw_split_out, f)
-        df = pandas.read_parquet(str(full_path))
-        df["load_path"] = raw_split_out
-        df["load_time"] = datetime.datetime.now()
-
-        if inspect(db_conn).has_table(get_raw_load_table_name(f)):
-            # Selecting max from staging even though this ETL logic should only upload from a directory once
-            # better safe than sorry
-            prev_loads = db_conn.execute(f"""
-            SELECT max(load_time)
-            from {get_raw_load_table_name(f)} 
-            where load_path = '{raw_split_out}';""").first()[0]
+def add_missing_staging_columns(db_conn, table_name, columns):
+    # Staging tables created by older loads do not have the newer columns yet
+    db_inspector = inspect(db_conn)
+    if not db_inspector.has_table(table_name):
+        return
+    existing = [c["name"] for c in db_inspector.get_columns(table_name)]
+    for column, column_type in columns.items():
+        if column not in existing:
+            db_conn.execute(f"ALTER TABLE {table_name} ADD COLUMN {column} {column_type};")
+
+
+def add_completeness_ids(df, category, completeness_cache):
+    completeness_table = CATEGORIES[category]["completeness_table"]
+    columns = CATEGORIES[category]["columns"]
+    df["data_completeness_id"] = completeness_cache.assign_ids(df, completeness_table, columns)
+
+
+def get_previous_load_time(db_conn, table_name, load_path):
+    if not inspect(db_conn).has_table(table_name):
+        return None
+    return db_conn.execute(f"""
+        SELECT max(load_time)
+        from {table_name}
+        where load_path = '{load_path}';""").first()[0]
+
+
+def get_staging_columns(category):
+    # The columns a split file or dataset needs to contribute to its staging table
+    if category == "stations":
+        return STATION_COLUMNS
+    return get_category_columns(category) + ["row_hash"]
+
+
+def prepare_staging_df(df, category, load_path, load_time, completeness_cache=None):
+    df["load_path"] = load_path
+    df["load_time"] = load_time
+    if category in CATEGORIES:
+        # Split files written before rows were hashed get their hashes here
+        if "row_hash" not in df.columns:
+            df["row_hash"] = compute_row_hash(df, category)
+        if completeness_cache is not None:
+            add_completeness_ids(df, category, completeness_cache)
+    return df
+
+
+def analyze_staging_tables(db_conn):
+    for name in [*CATEGORY_EXTRACTORS, "stations"]:
+        if inspect(db_conn).has_table(f"{name}_staging"):
+            analyze_table(db_conn, f"{name}_staging")
+
+
+def stage_dfs(db_conn, dfs, category, load_path, load_time, batch_size=DEFAULT_COPY_BATCH_SIZE,
+              completeness_cache=None, analyze=True):
+    # dfs is consumed lazily and copied in one transaction, so a failed stream leaves no partial load behind.
+    # Callers staging many small loads pass analyze=False and run analyze_staging_tables once at the end.
+    table_name = f"{category}_staging"
+    if category in CATEGORIES:
+        add_missing_staging_columns(db_conn, table_name, STAGING_EXTRA_COLUMNS)
+    prepared = (prepare_staging_df(df, category, load_path, load_time, completeness_cache) for df in dfs)
+    rows = copy_dfs_to_table(db_conn, prepared, table_name, batch_size)
+    if analyze and rows:
+        analyze_table(db_conn, table_name)
+    return rows
+
+
+def stage_df(db_conn, df, category, load_path, load_time, batch_size=DEFAULT_COPY_BATCH_SIZE,
+             completeness_cache=None, analyze=True):
+    return stage_dfs(db_conn, [df], category, load_path, load_time, batch_size, completeness_cache, analyze)
+
+
+def iter_parquet_batches(path, columns, batch_size=DEFAULT_COPY_BATCH_SIZE):
+    # Reads only the projected columns, one batch of row groups at a time
+    parquet_file = pq.ParquetFile(str(path))
+    available = parquet_file.schema_arrow.names
+    for batch in parquet_file.iter_batches(batch_size=batch_size, columns=[c for c in columns if c in available]):
+        yield batch.to_pandas()
+
+
+def iter_dataset_batches(dataset, columns, filter=None, batch_size=DEFAULT_COPY_BATCH_SIZE):
+    available = dataset.schema.names
+    for batch in dataset.to_batches(columns=[c for c in columns if c in available], filter=filter,
+                                    batch_size=batch_size):
+        if batch.num_rows:
+            yield batch.to_pandas()
+
+
+def get_dataset_load_path(dataset_root, run_id, years=None, stations=None):
+    load_path = f"{dataset_root}/run={run_id}"
+    if years is not None:
+        load_path += f"/year={','.join(str(y) for y in sorted(years))}"
+    if stations is not None:
+        load_path += f"/station={','.join(sorted(stations))}"
+    return load_path
+
+
+@traced
+def raw_dataset_to_db(db_conn, dataset_root, run_id=None, years=None, stations=None,
+                      batch_size=DEFAULT_COPY_BATCH_SIZE, completeness_cache=None):
+    # Only the partitions matching years/stations are opened, and only files written by run_id when it is set
+    if completeness_cache is None:
+        completeness_cache = CompletenessCache(db_conn)
+    rows_loaded = 0
+    for name in [*CATEGORY_EXTRACTORS, "stations"]:
+        if name == "stations":
+            partition_schema, filter = STATION_PARTITIONING, partition_filter(stations=stations)
         else:
-            prev_loads = None
+            partition_schema, filter = CATEGORY_PARTITIONING, partition_filter(years, stations)
+        load_path = get_dataset_load_path(dataset_root, run_id, years, stations)
+
+        prev_loads = get_previous_load_time(db_conn, f"{name}_staging", load_path)
+        if prev_loads:
+            logger.info(f"Previous load found from {prev_loads}. Skipping load to staging.")
+            continue
+        dataset = open_category_dataset(dataset_root, name, partition_schema, run_id, filter)
+        if dataset is None:
+            logger.info(f"No {name} partitions match in {dataset_root}")
+            continue
+
+        batches = iter_dataset_batches(dataset, get_staging_columns(name), filter, batch_size)
+        rows_loaded += stage_dfs(db_conn, batches, name, load_path, datetime.datetime.now(), batch_size,
+                                 completeness_cache)
+    current_span().set(rows=rows_loaded)
+    return rows_loaded
+
+
+def prepare_staging_tables(db_conn, raw_split_out):
+    # Creates the staging tables a split loads into, and adds their missing columns, from the split's schemas.
+    # Concurrent loads run this once first, so they never race each other to CREATE or ALTER the same table.
+    for name in [*CATEGORY_EXTRACTORS, "stations"]:
+        full_path = get_split_file_path(raw_split_out, name)
+        if not full_path.exists():
+            continue
+        schema = pq.read_schema(str(full_path))
+        columns = [c for c in get_staging_columns(name) if c in schema.names]
+        empty_df = schema.empty_table().select(columns).to_pandas()
+        create_table_from_df(db_conn, prepare_staging_df(empty_df, name, raw_split_out, datetime.datetime.now()),
+                             get_raw_load_table_name(full_path))
+        if name in CATEGORIES:
+            add_missing_staging_columns(db_conn, get_raw_load_table_name(full_path), STAGING_EXTRA_COLUMNS)
+
+
+@traced
+def raw_split_file_to_db(db_conn, raw_split_out, batch_size=DEFAULT_COPY_BATCH_SIZE, completeness_cache=None,
+                         analyze=True):
+    if completeness_cache is None:
+        completeness_cache = CompletenessCache(db_conn)
+    rows_loaded = 0
+    # Stations go last, matching the order the split writes them in
+    for name in [*CATEGORY_EXTRACTORS, "stations"]:
+        full_path = get_split_file_path(raw_split_out, name)
+        if not full_path.exists():
+            continue
+
+        # Selecting max from staging even though this ETL logic should only upload from a directory once
+        # better safe than sorry
+        prev_loads = get_previous_load_time(db_conn, get_raw_load_table_name(full_path), raw_split_out)
 
         if prev_loads:
             logger.info(f"Previous load found from {prev_loads}. Skipping load to staging.")
         else:
-            df.to_sql(get_raw_load_table_name(f), db_conn, if_exists="append", index=False)
+            current_span().add(bytes_read=full_path.stat().st_size)
+            batches = iter_parquet_batches(full_path, get_staging_columns(name), batch_size)
+            rows_loaded += stage_dfs(db_conn, batches, name, raw_split_out, datetime.datetime.now(), batch_size,
+                                     completeness_cache, analyze)
+    current_span().set(rows=rows_loaded)
+    return rows_loaded
+
+
+def split_chunks_to_queues(chunk_queue, category_queues, archive_path, to_archive, cancelled):
+    # Each parsed chunk becomes one Arrow table per category, handed to that category's loader and the archive
+    names = [name for name in CATEGORY_EXTRACTORS if name in category_queues or name in to_archive]
+    station_tables = []
+    writers = {}
+    rows = 0
+    completed = False
+    try:
+        for chunk, chunk_table in iter_chunk_tables(iter_queue(chunk_queue, cancelled)):
+            rows += chunk_table.num_rows
+            station_tables.append(extract_station_info(chunk_table))
+            for name in names:
+                table = extract_category_table(chunk_table, chunk, name)
+                if name in to_archive:
+                    write_chunk(writers, name, table, archive_path)
+                if name in category_queues:
+                    put_item(category_queues[name], table, cancelled)
+        completed = True
+        for category_queue in category_queues.values():
+            put_item(category_queue, QUEUE_END, cancelled)
+    finally:
+        close_writers(writers, archive_path, completed)
+    return rows, station_tables
+
+
+def iter_queued_dfs(table_queue, cancelled):
+    for table in iter_queue(table_queue, cancelled):
+        yield table.to_pandas()
+
+
+@traced
+def stream_hourly_data_to_db(db_conn, main_chunks, load_path, archive_path=None, batch_size=DEFAULT_COPY_BATCH_SIZE,
+                             queue_size=DEFAULT_QUEUE_SIZE, completeness_cache=None):
+    # Parsing, splitting and one COPY per category run at the same time, joined by queues of at most queue_size
+    # chunks, so nothing round trips through parquet. archive_path keeps the split files as a side output.
+    # Each category loads in its own transaction. A failing stage cancels the others, but a category that already
+    # committed stays loaded, so a rerun skips it and fills in the categories that rolled back.
+    if completeness_cache is None:
+        completeness_cache = CompletenessCache(db_conn)
+    to_load = []
+    for name in [*CATEGORY_EXTRACTORS, "stations"]:
+        prev_loads = get_previous_load_time(db_conn, f"{name}_staging", load_path)
+        if prev_loads:
+            logger.info(f"Previous {name} load found from {prev_loads}. Skipping load to staging.")
+        else:
+            to_load.append(name)
+
+    to_archive = []
+    archive_stations = False
+    if archive_path is not None:
+        os.makedirs(archive_path, exist_ok=True)
+        to_archive = [name for name in CATEGORY_EXTRACTORS if not get_split_file_path(archive_path, name).exists()]
+        archive_stations = not get_split_file_path(archive_path, "stations").exists()
+    if not to_load and not to_archive and not archive_stations:
+        logger.info("Nothing left to load or archive. Skipping")
+        return 0
 
+    load_time = datetime.datetime.now()
+    cancelled = threading.Event()
+    chunk_queue = queue.Queue(queue_size)
+    category_queues = {name: queue.Queue(queue_size) for name in to_load if name != "stations"}
+    stage = in_current_span(run_stage)
+    with ThreadPoolExecutor(max_workers=len(category_queues) + 2, thread_name_prefix="direct_load") as pool:
+        parse = pool.submit(stage, cancelled, fill_queue, chunk_queue, main_chunks, cancelled)
+        split = pool.submit(stage, cancelled, split_chunks_to_queues, chunk_queue, category_queues, archive_path,
+                            to_archive, cancelled)
+        loads = [pool.submit(stage, cancelled, stage_dfs, db_conn, iter_queued_dfs(category_queue, cancelled),
+                             name, load_path, load_time, batch_size, completeness_cache)
+                 for name, category_queue in category_queues.items()]
+        _, (rows, station_tables), *loaded = get_stage_results([parse, split, *loads])
 
+    if station_tables:
+        stations_df = dedupe_stations(station_tables)
+        if archive_stations:
+            write_df(stations_df, str(pathlib.Path(archive_path, "stations")))
+        if "stations" in to_load:
+            loaded.append(stage_df(db_conn, stations_df, "stations", load_path, load_time, batch_size))
+    rows_loaded = sum(loaded)
+    current_span().set(rows=rows_loaded)
+    logger.info(f"Streamed {rows} parsed rows into {rows_loaded} staging rows")
+    return rows_loaded
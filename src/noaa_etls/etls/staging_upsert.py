@@ -1,8 +1,13 @@
 import sys
+import time
 import logging
 import datetime
+import functools
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import pandas
-from sqlalchemy import create_engine
+from noaa_etls.lib.noaa_completeness_lib import completeness_lock_sql
+from noaa_etls.lib.noaa_categories import CATEGORIES
+from noaa_etls.lib.noaa_trace_lib import traced, current_span, span, in_current_span
 
 logging.basicConfig(
     level=logging.INFO,
@@ -10,26 +15,59 @@ logging.basicConfig(
 )
 logger = logging.getLogger("noaa_staging_upsert")
 
+DEFAULT_UPSERT_WORKERS = 4
+# Serializes load_tracking inserts, category upserts staged under the same load run in parallel
+LOAD_TRACKING_LOCK_SQL = "select pg_advisory_xact_lock(hashtext('load_tracking'));"
+DEFAULT_UPSERT_ENGINE = "delete_insert"
+# Stations per batch, or days per batch, when upserting in batches
+UPSERT_BATCH_SIZES = {
+    "station": 50,
+    "date": 31
+}
 
+
+@traced
 def get_new_load_rows(cur, staging_table):
-    cur.execute(f"""INSERT INTO load_tracking (load_source, load_time)
-            (select distinct load_path, load_time from {staging_table}
-            except select load_source, load_time from load_tracking)""")
+    # run_upsert registers every staged load before the categories start, so the lock, which is held to the end of
+    # the category's transaction, is only taken when a load turned up since
+    new_loads_sql = f"""select distinct load_path, load_time from {staging_table}
+            except select load_source, load_time from load_tracking"""
+    if cur.execute(f"select exists ({new_loads_sql});").first()[0]:
+        cur.execute(LOAD_TRACKING_LOCK_SQL)
+        cur.execute(f"INSERT INTO load_tracking (load_source, load_time) ({new_loads_sql})")
+
+
+def register_staged_loads(db_conn):
+    with db_conn.begin() as cur:
+        for staging_table in ["stations_staging", *(c["staging_table"] for c in UPSERT_CATEGORIES.values())]:
+            if cur.execute(f"select to_regclass('{staging_table}') is not null;").first()[0]:
+                get_new_load_rows(cur, staging_table)
+
+
+def date_range_filter(column, date_range):
+    # Literal bounds let Postgres prune partitions of the final table at plan time
+    if date_range is None:
+        return ""
+    return f"AND {column} between '{date_range[0]}' and '{date_range[1]}'"
 
 
-def delete_updated_rows_from_final(cur, staging_table, final_table):
+@traced
+def delete_updated_rows_from_final(cur, staging_table, final_table, date_range=None):
     cur.execute(f"""
                        delete from {final_table}
                        where (station_id, date_time) in (select 
                        stations.id, {staging_table}.date_time from  {staging_table}
                        join stations on stations.station_id = {staging_table}.station
-                       );
+                       )
+                       {date_range_filter("date_time", date_range)};
                        """)
 
 
+@traced
 def update_completeness_table(cur, staging_table, completness_table, columns):
     cols_string = ",\n".join(columns)
     cols_complete_string = ",\n".join(f"{c}_completeness" for c in columns)
+    cur.execute(completeness_lock_sql(completness_table))
     cur.execute(
         f"""
         with new_completeness as (
@@ -47,10 +85,90 @@ def update_completeness_table(cur, staging_table, completness_table, columns):
     )
 
 
-def insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns):
-    cols_string = ",\n".join(columns)
-    cols_string_stg_prefix = ",\n".join(f"stg.{c}" for c in columns)
+def staging_has_column(cur, staging_table, column):
+    return cur.execute(f"""
+        select exists (select 1 from information_schema.columns
+        where table_name = '{staging_table}' and column_name = '{column}');""").first()[0]
+
+
+def staging_has_completeness_ids(cur, staging_table):
+    return staging_has_column(cur, staging_table, "data_completeness_id")
+
+
+def row_changed_predicate(columns, use_hashes):
+    # Rows staged before the loader hashed them have no row_hash and always count as changed
+    if use_hashes:
+        return "(stg.row_hash is null or final_table.row_hash is distinct from stg.row_hash)"
+    return "(" + "\nOR ".join(f"stg.{c} <> final_table.{c}" for c in columns) + ")"
+
+
+def staging_has_changes(cur, staging_table, final_table):
+    # One probe of the (station_id, date_time) index per staged row, the hash is checked on the matched row
+    return cur.execute(f"""
+        select exists (
+        select 1 from {staging_table} stg
+        left join stations on stations.station_id = stg.station
+        left join {final_table} final_table
+        on final_table.station_id = stations.id
+        AND final_table.date_time = stg.date_time
+        AND final_table.row_hash = stg.row_hash
+        where final_table.station_id is null
+        );""").first()[0]
+
+
+@traced
+def skip_unchanged_staging(cur, staging_table, final_table):
+    # Returns True when staging only repeats what the final table already holds. Staging is cleared in that case.
+    if not staging_has_column(cur, staging_table, "row_hash") or \
+            staging_has_changes(cur, staging_table, final_table):
+        return False
+    logger.info(f"No changed rows in {staging_table}. Skipping upsert into {final_table}")
+    cur.execute(f"truncate {staging_table};")
+    return True
+
+
+@traced
+def backfill_completeness_ids(cur, staging_table, completeness_table, columns):
+    # Rows staged before the loader assigned completeness ids still need the flag join
+    if not cur.execute(f"""
+            select exists (select 1 from {staging_table} where data_completeness_id is null);""").first()[0]:
+        return
+    update_completeness_table(cur, staging_table, completeness_table, columns)
+    # Missing flags are NULL on both sides, matching the loader which keys them as ""
+    comp_join_string = "\nAND ".join(f"comp.{c} IS NOT DISTINCT FROM stg.{c}_completeness" for c in columns)
+    cur.execute(f"""
+        update {staging_table} stg
+        set data_completeness_id = comp.id
+        from {completeness_table} comp
+        where stg.data_completeness_id is null
+        AND {comp_join_string};
+        """)
+
+
+def prepare_completeness(cur, staging_table, completeness_table, columns):
+    # Returns whether staging already carries data_completeness_id
+    if staging_has_completeness_ids(cur, staging_table):
+        backfill_completeness_ids(cur, staging_table, completeness_table, columns)
+        return True
+    update_completeness_table(cur, staging_table, completeness_table, columns)
+    return False
+
+
+def completeness_id_source(completeness_table, columns, staging_has_ids):
+    # The id expression and join clause used to attach data_completeness_id to staged rows
+    if staging_has_ids:
+        return "stg.data_completeness_id", ""
     comp_join_string = "\nAND ".join(f"comp.{c} = stg.{c}_completeness" for c in columns)
+    return "comp.id", f"join {completeness_table} comp on\n{comp_join_string}"
+
+
+@traced
+def insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns, staging_has_ids=False,
+                             use_hashes=False):
+    # A key staged by more than one load goes in once, as its newest version
+    value_columns = columns + ["row_hash"] if use_hashes else columns
+    cols_string = ",\n".join(value_columns)
+    latest = select_latest_staged_rows(staging_table, completeness_table, columns, staging_has_ids, use_hashes)
 
     cur.execute(
         f"""
@@ -59,37 +177,38 @@ def insert_new_rows_to_final(cur, staging_table, final_table, completeness_table
         {cols_string}, 
         data_completeness_id, load_id)
 
-        select 
-        stations.id,
-        stg.date_time,
-        {cols_string_stg_prefix},
-         comp.id,
-         lt.id
+        select
+        station_id,
+        date_time,
+        {cols_string},
+        data_completeness_id,
+        load_id
 
-        from {staging_table} stg
-        join load_tracking lt on lt.load_time = stg.load_time
-        and lt.load_source = stg.load_path
-        join stations on stations.station_id = stg.station
-        join {completeness_table} comp on
-        {comp_join_string}
+        from ({latest}) latest
         """
     )
 
 
-def delete_upserted_from_staging(cur, staging_table, final_table, columns):
-    col_join = "\nOR ".join(f"stg.{c} <> final_table.{c}" for c in columns)
+@traced
+def delete_upserted_from_staging(cur, staging_table, final_table, columns, date_range=None, use_hashes=False):
+    # Only the newest staged version of a key is compared with the final table. When it is unchanged every version
+    # of the key is dropped, so an older one never replaces newer data.
     cur.execute(f"""
-               with new_data as (
+               with latest as (
+               select distinct on (station, date_time) *
+               from {staging_table}
+               order by station, date_time, load_time desc
+               ),
+               new_data as (
                select stg.station,
                stg.date_time
-               from {staging_table} stg
+               from latest stg
                left join stations st on st.station_id = stg.station
                left join {final_table} final_table
                on final_table.station_id = st.id 
                AND final_table.date_time = stg.date_time
-               AND ( 
-               {col_join}
-               )
+               {date_range_filter("final_table.date_time", date_range)}
+               AND {row_changed_predicate(columns, use_hashes)}
                left join load_tracking on load_tracking.id = final_table.load_id
                where load_tracking.load_time is null or load_tracking.load_time < stg.load_time
                )
@@ -98,6 +217,69 @@ def delete_upserted_from_staging(cur, staging_table, final_table, columns):
                """)
 
 
+def get_partition_settings(cur, final_table):
+    # None when the final table is not partitioned, otherwise whether years are sub-partitioned by station
+    if cur.execute("select to_regclass('partition_settings');").first()[0] is None:
+        return None
+    row = cur.execute(f"""
+        select subpartition_by_station from partition_settings
+        where table_name = '{final_table}';""").first()
+    return None if row is None else row[0]
+
+
+def get_partition_name(final_table, year, station_id=None):
+    if station_id is None:
+        return f"{final_table}_{year}"
+    return f"{final_table}_{year}_s{station_id}"
+
+
+def create_partitions(cur, staging_table, final_table, subpartition_by_station):
+    years = [x[0] for x in cur.execute(f"""
+        select distinct extract(year from date_time)::int from {staging_table}
+        where date_time is not null;""").fetchall()]
+    for year in years:
+        sub_partition_clause = " PARTITION BY LIST (station_id)" if subpartition_by_station else ""
+        cur.execute(f"""
+            CREATE TABLE if not exists {get_partition_name(final_table, year)}
+            PARTITION OF {final_table}
+            FOR VALUES FROM ('{year}-01-01') TO ('{year + 1}-01-01'){sub_partition_clause};""")
+        if subpartition_by_station:
+            cur.execute(f"""
+                CREATE TABLE if not exists {get_partition_name(final_table, year)}_default
+                PARTITION OF {get_partition_name(final_table, year)} DEFAULT;""")
+
+    if subpartition_by_station:
+        station_years = cur.execute(f"""
+            select distinct stations.id, extract(year from stg.date_time)::int
+            from {staging_table} stg
+            join stations on stations.station_id = stg.station
+            where stg.date_time is not null;""").fetchall()
+        for station_id, year in station_years:
+            cur.execute(f"""
+                CREATE TABLE if not exists {get_partition_name(final_table, year, station_id)}
+                PARTITION OF {get_partition_name(final_table, year)}
+                FOR VALUES IN ({station_id});""")
+
+
+@traced
+def prepare_partitions(cur, staging_table, final_table):
+    # Create any partitions this load needs and return the staged date range so statements only touch them
+    subpartition_by_station = get_partition_settings(cur, final_table)
+    if subpartition_by_station is None:
+        return None
+
+    create_partitions(cur, staging_table, final_table, subpartition_by_station)
+    date_range = cur.execute(f"select min(date_time), max(date_time) from {staging_table};").first()
+    return None if date_range[0] is None else tuple(date_range)
+
+
+def detach_year_partition(db_conn, final_table, year):
+    logger.info(f"Detaching {year} from {final_table}")
+    with db_conn.begin() as cur:
+        cur.execute(f"ALTER TABLE {final_table} DETACH PARTITION {get_partition_name(final_table, year)};")
+
+
+@traced
 def upsert_stations(db_conn):
     with db_conn.begin() as cur:
         # Find only where data has changed
@@ -141,121 +323,420 @@ def upsert_stations(db_conn):
         )
 
 
-def upsert_dewpt(db_conn):
-    logger.info("Upserting dewpt")
+# Declared once in noaa_categories, shared with the split and staging loaders
+UPSERT_CATEGORIES = CATEGORIES
 
-    staging_table = "dewpt_staging"
-    final_table = "hourly_dew_point_data"
-    completeness_table = "hourly_dew_point_data_completeness"
-    columns = [
-        "hourly_dew_point_tenth_percentile",
-        "hourly_dew_point_ninetieth_percentile",
-        "hourly_dew_point_mean"
-    ]
 
-    with db_conn.begin() as cur:
-        delete_upserted_from_staging(cur, staging_table, final_table, columns)
+def create_upsert_checkpoint_table(db_conn):
+    db_conn.execute("""CREATE TABLE if not exists UPSERT_CHECKPOINTS (
+                    staging_table text primary key,
+                    batch_by text,
+                    batches_done integer,
+                    rows_upserted bigint,
+                    last_key text,
+                    started_at timestamp,
+                    updated_at timestamp,
+                    finished boolean
+                    );""")
 
-        delete_updated_rows_from_final(cur, staging_table, final_table)
-        get_new_load_rows(cur, staging_table)
 
-        # add in new completeness
-        update_completeness_table(cur, staging_table, completeness_table, columns)
+def start_checkpoint(cur, staging_table, batch_by):
+    checkpoint = cur.execute(f"""
+        select batches_done, last_key, finished from upsert_checkpoints
+        where staging_table = '{staging_table}';""").first()
+    if checkpoint is not None and not checkpoint[2]:
+        logger.info(f"Resuming {staging_table} after {checkpoint[0]} completed batches, the last ending at "
+                    f"{checkpoint[1]}")
+        return
+    cur.execute(f"""
+        INSERT INTO upsert_checkpoints (staging_table, batch_by, batches_done, rows_upserted, last_key, started_at,
+        updated_at, finished)
+        values ('{staging_table}', '{batch_by}', 0, 0, null, now(), now(), false)
+        on conflict (staging_table) do update set batch_by = excluded.batch_by, batches_done = 0, rows_upserted = 0,
+        last_key = null, started_at = now(), updated_at = now(), finished = false;""")
 
-        insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns)
-        cur.execute(f"truncate {staging_table};")
 
+def record_checkpoint(cur, staging_table, key_range, rows):
+    cur.execute(f"""
+        update upsert_checkpoints set batches_done = batches_done + 1, rows_upserted = rows_upserted + {rows},
+        last_key = '{key_range[1]}', updated_at = now()
+        where staging_table = '{staging_table}';""")
+
+
+def finish_checkpoint(cur, staging_table):
+    cur.execute(f"""
+        update upsert_checkpoints set finished = true, updated_at = now()
+        where staging_table = '{staging_table}';""")
+
+
+def get_batch_key_ranges(cur, staging_table, batch_by, batch_size):
+    # Ranges split on the staging key, so every staged version of a (station, date_time) lands in the same batch
+    if batch_by == "station":
+        stations = [x[0] for x in cur.execute(f"""
+            select distinct station from {staging_table} where station is not null order by station;""").fetchall()]
+        return [(stations[i], stations[min(i + batch_size, len(stations)) - 1])
+                for i in range(0, len(stations), batch_size)]
+
+    first, last = cur.execute(f"select min(date_time), max(date_time) from {staging_table};").first()
+    key_ranges = []
+    window = datetime.timedelta(days=batch_size)
+    while first is not None and first <= last:
+        key_ranges.append((first, first + window))
+        first += window
+    return key_ranges
+
+
+def batch_key_filter(batch_by, key_range):
+    if batch_by == "station":
+        return f"station between '{key_range[0]}' and '{key_range[1]}'"
+    return f"date_time >= '{key_range[0]}' AND date_time < '{key_range[1]}'"
+
+
+def move_batch_to_temp(cur, staging_table, batch_by, key_range):
+    # The batch leaves staging in the same transaction that writes it to the final table, so a committed batch is
+    # never redone and a failed one is still in staging for the next run
+    batch_table = f"{staging_table}_batch"
+    cur.execute(f"CREATE TEMP TABLE {batch_table} (like {staging_table}) on commit drop;")
+    rows = cur.execute(f"""
+        with moved as (
+            delete from {staging_table}
+            where {batch_key_filter(batch_by, key_range)}
+            returning *
+        )
+        insert into {batch_table} select * from moved;""").rowcount
+    cur.execute(f"ANALYZE {batch_table};")
+    return batch_table, rows
 
-def upsert_pressure(db_conn):
-    logger.info("Upserting pressure")
 
-    staging_table = "pressure_staging"
-    final_table = "hourly_pressure_data"
-    completeness_table = "hourly_pressure_data_completeness"
-    columns = [
-              "hourly_sea_level_pressure_tenth_percentile",
-              "hourly_sea_level_pressure_ninetieth_percentile",
-              "hourly_sea_level_pressure_mean"
-          ]
+@traced
+def upsert_category_in_batches(db_conn, category, apply_upsert, batch_by, batch_size=None):
+    staging_table = UPSERT_CATEGORIES[category]["staging_table"]
+    final_table = UPSERT_CATEGORIES[category]["final_table"]
+    completeness_table = UPSERT_CATEGORIES[category]["completeness_table"]
+    columns = UPSERT_CATEGORIES[category]["columns"]
+    batch_size = batch_size or UPSERT_BATCH_SIZES[batch_by]
 
+    create_upsert_checkpoint_table(db_conn)
     with db_conn.begin() as cur:
-        delete_upserted_from_staging(cur, staging_table, final_table, columns)
+        if skip_unchanged_staging(cur, staging_table, final_table):
+            finish_checkpoint(cur, staging_table)
+            return
+        key_ranges = get_batch_key_ranges(cur, staging_table, batch_by, batch_size)
+        start_checkpoint(cur, staging_table, batch_by)
+
+    logger.info(f"Upserting {staging_table} in {len(key_ranges)} batches of {batch_size} by {batch_by}")
+    for i, key_range in enumerate(key_ranges):
+        # Each batch commits on its own, so locks on the final table last one batch
+        with span("upsert_batch", category=category, key_range=[str(k) for k in key_range]) as batch_span, \
+                db_conn.begin() as cur:
+            batch_table, rows = move_batch_to_temp(cur, staging_table, batch_by, key_range)
+            if rows:
+                apply_upsert(cur, batch_table, final_table, completeness_table, columns)
+            record_checkpoint(cur, staging_table, key_range, rows)
+            batch_span.set(rows=rows)
+        logger.info(f"{staging_table} batch {i + 1}/{len(key_ranges)} ({key_range[0]} to {key_range[1]}): "
+                    f"{rows} rows")
 
-        delete_updated_rows_from_final(cur, staging_table, final_table)
-        get_new_load_rows(cur, staging_table)
+    with db_conn.begin() as cur:
+        # Rows without a station or date_time never join to the final table, the unbatched upsert drops them too
+        cur.execute(f"delete from {staging_table} where station is null or date_time is null;")
+        finish_checkpoint(cur, staging_table)
 
-        # add in new completeness
-        update_completeness_table(cur, staging_table, completeness_table, columns)
 
-        insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns)
-        cur.execute(f"truncate {staging_table};")
+def apply_delete_insert(cur, staging_table, final_table, completeness_table, columns):
+    use_hashes = staging_has_column(cur, staging_table, "row_hash")
+    date_range = prepare_partitions(cur, staging_table, final_table)
+    delete_upserted_from_staging(cur, staging_table, final_table, columns, date_range, use_hashes)
 
+    delete_updated_rows_from_final(cur, staging_table, final_table, date_range)
+    get_new_load_rows(cur, staging_table)
 
-def upsert_temp(db_conn):
-    logger.info("Upserting temp")
-
-    staging_table = "temp_staging"
-    final_table = "hourly_temperature_data"
-    completeness_table = "hourly_temperature_data_completeness"
-    columns = [
-        "hourly_temperature_tenth_percentile",
-        "hourly_temperature_ninetieth_percentile",
-        "hourly_temperature_mean",
-        "hourly_cooling_degree_hours_mean",
-        "hourly_heating_degree_hours_mean",
-        "hourly_heat_index_mean"
-    ]
+    # add in new completeness
+    staging_has_ids = prepare_completeness(cur, staging_table, completeness_table, columns)
 
-    with db_conn.begin() as cur:
+    insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns, staging_has_ids,
+                             use_hashes)
 
-        delete_upserted_from_staging(cur, staging_table, final_table, columns)
 
-        delete_updated_rows_from_final(cur, staging_table, final_table)
-        get_new_load_rows(cur, staging_table)
+def run_category_upsert(db_conn, category, apply_upsert, batch_by=None, batch_size=None):
+    # apply_upsert writes one staging table's rows to the final table. Unbatched, that is the whole staging table in
+    # one transaction.
+    if batch_by is not None:
+        return upsert_category_in_batches(db_conn, category, apply_upsert, batch_by, batch_size)
 
-        # add in new completeness
-        update_completeness_table(cur, staging_table, completeness_table, columns)
+    staging_table = UPSERT_CATEGORIES[category]["staging_table"]
+    final_table = UPSERT_CATEGORIES[category]["final_table"]
+    completeness_table = UPSERT_CATEGORIES[category]["completeness_table"]
+    columns = UPSERT_CATEGORIES[category]["columns"]
 
-        insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns)
+    with db_conn.begin() as cur:
+        if skip_unchanged_staging(cur, staging_table, final_table):
+            return
+        apply_upsert(cur, staging_table, final_table, completeness_table, columns)
         cur.execute(f"truncate {staging_table};")
 
 
-def upsert_wind(db_conn):
-    logger.info("Upserting wind")
-
-    staging_table = "wind_staging"
-    final_table = "hourly_wind_data"
-    completeness_table = "hourly_wind_data_completeness"
-    columns = [
-        "hourly_wind_chill_mean",
-        "hourly_wind_prevailing_direction",
-        "hourly_wind_prevailing_percentage",
-        "hourly_wind_secondary_direction",
-        "hourly_wind_secondary_percentage",
-        "hourly_wind_average_speed",
-        "hourly_wind_percentage_calm",
-        "hourly_wind_mean_vector_direction",
-        "hourly_wind_mean_vector_magnitude"
-    ]
+@traced
+def upsert_category(db_conn, category, batch_by=None, batch_size=None):
+    logger.info(f"Upserting {category}")
+    current_span().set(category=category)
+    run_category_upsert(db_conn, category, apply_delete_insert, batch_by, batch_size)
+
+
+def select_latest_staged_rows(staging_table, completeness_table, columns, staging_has_ids=False, use_hashes=False):
+    # The newest staged version of each key, with the ids the final table stores
+    value_columns = columns + ["row_hash"] if use_hashes else columns
+    cols_string_stg_prefix = ",\n".join(f"stg.{c}" for c in value_columns)
+    comp_id, comp_join = completeness_id_source(completeness_table, columns, staging_has_ids)
+    return f"""
+        select distinct on (stations.id, stg.date_time)
+        stations.id as station_id,
+        stg.date_time,
+        {cols_string_stg_prefix},
+        {comp_id} as data_completeness_id,
+        lt.id as load_id,
+        stg.load_time
+
+        from {staging_table} stg
+        join load_tracking lt on lt.load_time = stg.load_time
+        and lt.load_source = stg.load_path
+        join stations on stations.station_id = stg.station
+        {comp_join}
+        order by stations.id, stg.date_time, stg.load_time desc
+        """
 
-    with db_conn.begin() as cur:
-        delete_upserted_from_staging(cur, staging_table, final_table, columns)
 
-        delete_updated_rows_from_final(cur, staging_table, final_table)
-        get_new_load_rows(cur, staging_table)
+def select_changed_rows(staging_table, final_table, completeness_table, columns, date_range=None,
+                        staging_has_ids=False, use_hashes=False):
+    # One pass over staging: take the newest staged row per key, then keep it only if it is new or differs from a
+    # final row that was loaded earlier. Filtering first would let an older staged version win when the newest one
+    # matches the final table.
+    value_columns = columns + ["row_hash"] if use_hashes else columns
+    cols_string_stg_prefix = ",\n".join(f"stg.{c}" for c in value_columns)
+    if use_hashes:
+        # The hash covers the values and their completeness flags
+        changed = row_changed_predicate(columns, use_hashes)
+    else:
+        final_values = ", ".join([f"final_table.{c}" for c in columns] + ["final_table.data_completeness_id"])
+        # Compare at the final table's real precision, otherwise double precision staging values never match
+        stg_values = ", ".join([f"stg.{c}::real" for c in columns] + ["stg.data_completeness_id"])
+        changed = f"({final_values}) is distinct from ({stg_values})"
+
+    return f"""
+        select
+        stg.station_id,
+        stg.date_time,
+        {cols_string_stg_prefix},
+        stg.data_completeness_id,
+        stg.load_id
+
+        from ({select_latest_staged_rows(staging_table, completeness_table, columns, staging_has_ids, use_hashes)}) stg
+        left join {final_table} final_table
+        on final_table.station_id = stg.station_id
+        AND final_table.date_time = stg.date_time
+        {date_range_filter("final_table.date_time", date_range)}
+        left join load_tracking final_lt on final_lt.id = final_table.load_id
+        where final_table.station_id is null
+        or (
+            {changed}
+            AND (final_lt.load_time is null or final_lt.load_time < stg.load_time)
+        )
+        """
 
-        # add in new completeness
-        update_completeness_table(cur, staging_table, completeness_table, columns)
 
-        insert_new_rows_to_final(cur, staging_table, final_table, completeness_table, columns)
-        cur.execute(f"truncate {staging_table};")
+@traced
+def upsert_changed_rows_on_conflict(cur, staging_table, final_table, completeness_table, columns, date_range=None,
+                                    staging_has_ids=False, use_hashes=False):
+    value_columns = columns + ["row_hash"] if use_hashes else columns
+    cols_string = ",\n".join(value_columns)
+    set_string = ",\n".join(f"{c} = excluded.{c}" for c in value_columns)
+
+    cur.execute(
+        f"""
+        INSERT INTO {final_table}
+        (station_id, date_time,
+        {cols_string},
+        data_completeness_id, load_id)
+        {select_changed_rows(staging_table, final_table, completeness_table, columns, date_range, staging_has_ids,
+                             use_hashes)}
+        ON CONFLICT (station_id, date_time) DO UPDATE SET
+        {set_string},
+        data_completeness_id = excluded.data_completeness_id,
+        load_id = excluded.load_id;
+        """
+    )
+
+
+@traced
+def merge_changed_rows(cur, staging_table, final_table, completeness_table, columns, date_range=None,
+                       staging_has_ids=False, use_hashes=False):
+    value_columns = columns + ["row_hash"] if use_hashes else columns
+    cols_string = ",\n".join(value_columns)
+    cols_string_src_prefix = ",\n".join(f"src.{c}" for c in value_columns)
+    set_string = ",\n".join(f"{c} = src.{c}" for c in value_columns)
+
+    cur.execute(
+        f"""
+        MERGE INTO {final_table} final_table
+        USING ({select_changed_rows(staging_table, final_table, completeness_table, columns, date_range, staging_has_ids,
+                                    use_hashes)}) src
+        ON final_table.station_id = src.station_id
+        AND final_table.date_time = src.date_time
+        WHEN MATCHED THEN UPDATE SET
+        {set_string},
+        data_completeness_id = src.data_completeness_id,
+        load_id = src.load_id
+        WHEN NOT MATCHED THEN INSERT
+        (station_id, date_time,
+        {cols_string},
+        data_completeness_id, load_id)
+        VALUES (src.station_id, src.date_time,
+        {cols_string_src_prefix},
+        src.data_completeness_id, src.load_id);
+        """
+    )
+
+
+def apply_single_statement(cur, staging_table, final_table, completeness_table, columns, write_changed_rows):
+    use_hashes = staging_has_column(cur, staging_table, "row_hash")
+    date_range = prepare_partitions(cur, staging_table, final_table)
+    get_new_load_rows(cur, staging_table)
+
+    # add in new completeness
+    staging_has_ids = prepare_completeness(cur, staging_table, completeness_table, columns)
+
+    write_changed_rows(cur, staging_table, final_table, completeness_table, columns, date_range, staging_has_ids,
+                       use_hashes)
+
+
+@traced
+def upsert_category_single_statement(db_conn, category, write_changed_rows, batch_by=None, batch_size=None):
+    logger.info(f"Upserting {category}")
+    current_span().set(category=category)
+    apply_upsert = functools.partial(apply_single_statement, write_changed_rows=write_changed_rows)
+    run_category_upsert(db_conn, category, apply_upsert, batch_by, batch_size)
+
+
+def upsert_category_on_conflict(db_conn, category, batch_by=None, batch_size=None):
+    upsert_category_single_statement(db_conn, category, upsert_changed_rows_on_conflict, batch_by, batch_size)
+
 
+def upsert_category_merge(db_conn, category, batch_by=None, batch_size=None):
+    # MERGE needs Postgres 15+
+    upsert_category_single_statement(db_conn, category, merge_changed_rows, batch_by, batch_size)
 
-def run_upsert(db_uri):
-    db_conn = create_engine(db_uri)
-    upsert_stations(db_conn)
-    upsert_dewpt(db_conn)
-    upsert_pressure(db_conn)
-    upsert_temp(db_conn)
-    upsert_wind(db_conn)
+
+def upsert_dewpt(db_conn):
+    upsert_category(db_conn, "dewpt")
+
+
+def upsert_pressure(db_conn):
+    upsert_category(db_conn, "pressure")
+
+
+def upsert_temp(db_conn):
+    upsert_category(db_conn, "temp")
+
+
+def upsert_wind(db_conn):
+    upsert_category(db_conn, "wind")
+
+
+UPSERT_ENGINES = {
+    "delete_insert": upsert_category,
+    "on_conflict": upsert_category_on_conflict,
+    "merge": upsert_category_merge
+}
+
+# What each engine runs against one staging table inside its transaction
+UPSERT_APPLY_STEPS = {
+    "delete_insert": apply_delete_insert,
+    "on_conflict": functools.partial(apply_single_statement, write_changed_rows=upsert_changed_rows_on_conflict),
+    "merge": functools.partial(apply_single_statement, write_changed_rows=merge_changed_rows)
+}
+
+
+def get_upsert_steps(engine=DEFAULT_UPSERT_ENGINE, batch_by=None, batch_size=None):
+    # Stations stay one transaction, there is one row per station
+    steps = {"stations": upsert_stations}
+    for category in UPSERT_CATEGORIES:
+        steps[category] = functools.partial(UPSERT_ENGINES[engine], category=category, batch_by=batch_by,
+                                            batch_size=batch_size)
+    return steps
+
+
+# Measurement rows join to stations.id, so every category waits on the station upsert
+UPSERT_DEPENDENCIES = {
+    "stations": [],
+    "dewpt": ["stations"],
+    "pressure": ["stations"],
+    "temp": ["stations"],
+    "wind": ["stations"]
+}
+
+
+class UpsertError(Exception):
+    pass
+
+
+def timed_upsert(name, step, db_conn):
+    start_time = time.perf_counter()
+    step(db_conn)
+    elapsed = time.perf_counter() - start_time
+    logger.info(f"Upserted {name} in {elapsed:.2f}s")
+    return elapsed
+
+
+def run_upsert_graph(db_conn, steps, dependencies, workers):
+    # Each step commits or rolls back in its own transaction, so a failed step never leaves another half applied.
+    # Steps already running are allowed to finish; steps depending on a failure are skipped.
+    timings = {}
+    failed = {}
+    skipped = set()
+    pending = dict(dependencies)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while pending or running:
+            progress = True
+            while progress:
+                progress = False
+                for name, deps in list(pending.items()):
+                    if any(d in failed or d in skipped for d in deps):
+                        logger.error(f"Skipping {name} upsert because a dependency failed")
+                        skipped.add(name)
+                    elif all(d in timings for d in deps):
+                        running[pool.submit(in_current_span(timed_upsert), name, steps[name], db_conn)] = name
+                    else:
+                        continue
+                    del pending[name]
+                    progress = True
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                name = running.pop(future)
+                try:
+                    timings[name] = future.result()
+                except Exception as e:
+                    logger.exception(f"Upsert of {name} failed")
+                    failed[name] = e
+
+    if pending:
+        raise UpsertError(f"Unresolvable upsert dependencies for {sorted(pending)}")
+    if failed or skipped:
+        raise UpsertError(f"Upsert failed for {sorted(failed)}, skipped {sorted(skipped)}, "
+                          f"completed {sorted(timings)}")
+
+    logger.info("Upsert timings: " + ", ".join(f"{name}={elapsed:.2f}s" for name, elapsed in timings.items()))
+    return timings
+
+
+@traced
+def run_upsert(db_conn, workers=DEFAULT_UPSERT_WORKERS, engine=DEFAULT_UPSERT_ENGINE, batch_by=None, batch_size=None):
+    logger.info(f"Upserting with the {engine} engine" + (f" in batches by {batch_by}" if batch_by else ""))
+    register_staged_loads(db_conn)
+    return run_upsert_graph(db_conn, get_upsert_steps(engine, batch_by, batch_size), UPSERT_DEPENDENCIES, workers)
 
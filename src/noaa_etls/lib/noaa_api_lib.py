@@ -1,10 +1,30 @@
 import itertools
+import collections
 import os
+from concurrent.futures import ThreadPoolExecutor
+from noaa_etls.lib.noaa_cache_lib import cache_from_env
 import requests
+import requests.adapters
 
 TOKEN = os.environ.get("NOAA_TOKEN")
 
-BASE_URL = "https://www.ncdc.noaa.gov/cdo-web/api/v2/"
+# Overridable so the clients can be pointed at a local stub server
+BASE_URL = os.environ.get("NOAA_BASE_URL", "https://www.ncdc.noaa.gov/cdo-web/api/v2/")
+
+REQUEST_TIMEOUT = 60
+MAX_POOL_CONNECTIONS = 10
+
+DEFAULT_PREFETCH_PAGES = 2
+# Largest page the CDO API serves
+DEFAULT_DATA_PAGE_LIMIT = 1000
+# Results the CDO API returns when a request has no limit
+API_DEFAULT_LIMIT = 25
+# Default max_results of the get_* calls, capping the results at limit
+UP_TO_LIMIT = object()
+
+_session = None
+_cache = None
+_cache_configured = False
 
 
 def get_header():
@@ -13,6 +33,114 @@ def get_header():
     }
 
 
+def get_session():
+    # One pooled session per process so repeated calls reuse connections
+    global _session
+    if _session is None:
+        _session = build_session(MAX_POOL_CONNECTIONS)
+    return _session
+
+
+def build_session(max_connections):
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=max_connections, pool_maxsize=max_connections)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def configure_cache(cache):
+    # Pass a noaa_cache_lib.ResponseCache, or None to turn caching off
+    global _cache, _cache_configured
+    _cache = cache
+    _cache_configured = True
+
+
+def get_cache():
+    global _cache, _cache_configured
+    if not _cache_configured:
+        configure_cache(cache_from_env())
+    return _cache
+
+
+def get_cache_stats():
+    cache = get_cache()
+    return None if cache is None else cache.stats()
+
+
+def request_json(endpoint, params):
+    cache = get_cache()
+    if cache is None:
+        r = get_session().get(BASE_URL + endpoint, headers=get_header(), params=params, timeout=REQUEST_TIMEOUT)
+        r.raise_for_status()
+        return r.json()
+
+    key, entry, body = cache.lookup(endpoint, params)
+    if body is not None:
+        return body
+    headers = {**get_header(), **cache.conditional_headers(entry)}
+    r = get_session().get(BASE_URL + endpoint, headers=headers, params=params, timeout=REQUEST_TIMEOUT)
+    return cache.store_response(key, endpoint, r, entry)
+
+
+def paginate(endpoint, params, limit, max_results=None, prefetch=DEFAULT_PREFETCH_PAGES):
+    # Iterative, so stack depth stays flat, and at most `prefetch` pages are held in memory ahead of the caller
+    first_offset = params.get("offset", 1)
+    first_page = request_json(endpoint, {**params, "limit": limit, "offset": first_offset})
+    pages = [first_page]
+    offsets = iter([])
+    if "metadata" in first_page:
+        count = first_page["metadata"]["resultset"]["count"]
+        offsets = iter(plan_page_offsets(count, limit, first_offset, max_results))
+
+    yielded = 0
+    pending = collections.deque()
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as pool:
+        try:
+            for offset in itertools.islice(offsets, prefetch):
+                pending.append(pool.submit(request_json, endpoint, {**params, "limit": limit, "offset": offset}))
+            while pages:
+                for result in pages.pop().get("results", []):
+                    if max_results is not None and yielded >= max_results:
+                        return
+                    yield result
+                    yielded += 1
+                if pending:
+                    pages.append(pending.popleft().result())
+                    for offset in itertools.islice(offsets, 1):
+                        pending.append(pool.submit(request_json, endpoint,
+                                                   {**params, "limit": limit, "offset": offset}))
+                elif prefetch < 1:
+                    # Nothing fetched ahead, so request the next page only once the caller has consumed this one
+                    for offset in itertools.islice(offsets, 1):
+                        pages.append(request_json(endpoint, {**params, "limit": limit, "offset": offset}))
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+def plan_result_pages(limit, max_results=UP_TO_LIMIT):
+    # Returns (page size, max_results) for a get_* call. By default limit caps the results, the way a single request
+    # always has. max_results=None asks for the whole resultset.
+    if max_results is UP_TO_LIMIT:
+        max_results = limit or API_DEFAULT_LIMIT
+    page_size = min(limit or DEFAULT_DATA_PAGE_LIMIT, DEFAULT_DATA_PAGE_LIMIT)
+    if max_results is not None:
+        page_size = min(page_size, max_results)
+    return page_size, max_results
+
+
+def request_pages(endpoint, params, limit=None, max_results=UP_TO_LIMIT):
+    page_size, max_results = plan_result_pages(limit, max_results)
+    return list(paginate(endpoint, params, page_size, max_results))
+
+
+def plan_page_offsets(count, limit, first_offset=1, max_results=None):
+    # NOAA offsets are 1-based. Returns the offsets of every page after the one starting at first_offset.
+    last = count if max_results is None else min(count, first_offset - 1 + max_results)
+    return list(range(first_offset + limit, last + 1, limit))
+
+
 def get_data_sets(
         datatypeid=None,
         locationid=None,
@@ -22,7 +150,8 @@ def get_data_sets(
         sortfield=None,
         sortorder=None,
         limit=None,
-        offset=None
+        offset=None,
+        max_results=UP_TO_LIMIT
 ):
     params_raw = {
         "datatypeid": datatypeid,
@@ -32,13 +161,10 @@ def get_data_sets(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
-    r = requests.get(BASE_URL + "datasets", headers=get_header(), params=params)
-    r.raise_for_status()
-    return r.json()["results"]
+    return request_pages("datasets", params, limit, max_results)
 
 
 def get_data_categories(
@@ -50,7 +176,8 @@ def get_data_categories(
         sortfield=None,
         sortorder=None,
         limit=None,
-        offset=None
+        offset=None,
+        max_results=UP_TO_LIMIT
 ):
     params_raw = {
         "datasetid": datasetid,
@@ -60,13 +187,10 @@ def get_data_categories(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
-    r = requests.get(BASE_URL + "datacategories", headers=get_header(), params=params)
-    r.raise_for_status()
-    return r.json()["results"]
+    return request_pages("datacategories", params, limit, max_results)
 
 
 def get_location_categories(
@@ -76,7 +200,8 @@ def get_location_categories(
         sortfield=None,
         sortorder=None,
         limit=None,
-        offset=None
+        offset=None,
+        max_results=UP_TO_LIMIT
 ):
     params_raw = {
         "datasetid": datasetid,
@@ -84,13 +209,10 @@ def get_location_categories(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
-    r = requests.get(BASE_URL + "locationcategories", headers=get_header(), params=params)
-    r.raise_for_status()
-    return r.json()["results"]
+    return request_pages("locationcategories", params, limit, max_results)
 
 
 def get_locations(
@@ -102,7 +224,8 @@ def get_locations(
         sortfield=None,
         sortorder=None,
         limit=None,
-        offset=None
+        offset=None,
+        max_results=UP_TO_LIMIT
 ):
     params_raw = {
         "datasetid": datasetid,
@@ -112,13 +235,10 @@ def get_locations(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
-    r = requests.get(BASE_URL + "locations", headers=get_header(), params=params)
-    r.raise_for_status()
-    return r.json()["results"]
+    return request_pages("locations", params, limit, max_results)
 
 
 def get_stations(
@@ -145,23 +265,45 @@ def get_stations(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
-    r = requests.get(BASE_URL + "stations", headers=get_header(), params=params)
-    r.raise_for_status()
+    return paginate("stations", params, limit, max_results=genLimit)
 
-    metadata = r.json()["metadata"]
-    resultset = metadata["resultset"]
 
-    station_list = r.json()["results"]
+def get_station(stationid):
+    return request_json(f"stations/{stationid}", {})
 
-    newOffset = params.pop("offset", 1) + limit
-    station_iter = itertools.chain(station_list, get_stations(genLimit=genLimit, offset=newOffset, **params))
 
-    for i in itertools.islice(station_iter, genLimit):
-        yield i
+def iter_data(
+        datasetid=None,
+        datatypeid=None,
+        locationid=None,
+        stationid=None,
+        startdate=None,
+        enddate=None,
+        units="standard",
+        sortfield=None,
+        sortorder=None,
+        limit=DEFAULT_DATA_PAGE_LIMIT,
+        offset=None,
+        max_results=None,
+        prefetch=DEFAULT_PREFETCH_PAGES
+):
+    params_raw = {
+        "datasetid": datasetid,
+        "locationid": locationid,
+        "stationid": stationid,
+        "datatypeid": datatypeid,
+        "units": units,
+        "startdate": startdate,
+        "enddate": enddate,
+        "sortfield": sortfield,
+        "sortorder": sortorder,
+        "offset": offset
+    }
+    params = {k: v for k, v in params_raw.items() if v is not None}
+    return paginate("data", params, limit, max_results, prefetch)
 
 
 def get_data(
@@ -176,6 +318,7 @@ def get_data(
         sortorder=None,
         limit=None,
         offset=None,
+        max_results=UP_TO_LIMIT,
         inlucdemetadata=False
 ):
     params_raw = {
@@ -188,15 +331,12 @@ def get_data(
         "enddate": enddate,
         "sortfield": sortfield,
         "sortorder": sortorder,
-        "limit": limit,
         "offset": offset,
         #"inlucdemetadata": inlucdemetadata
     }
     params = {k: v for k, v in params_raw.items() if v is not None}
 
-    r = requests.get(BASE_URL + "data", headers=get_header(), params=params)
-    r.raise_for_status()
-    return r.json()["results"]
+    return request_pages("data", params, limit, max_results)
 
 
 # def do_a_test():
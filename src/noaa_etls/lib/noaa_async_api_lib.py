@@ -0,0 +1,293 @@
+import sys
+import time
+import asyncio
+import logging
+import collections
+from noaa_etls.lib import noaa_api_lib
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_async_api_lib")
+
+# NOAA CDO token quotas: https://www.ncdc.noaa.gov/cdo-web/webservices/v2
+REQUESTS_PER_SECOND = 5
+REQUESTS_PER_DAY = 10000
+MAX_RETRIES = 3
+RETRY_BACKOFF = 1.0
+RETRY_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class QuotaExceededError(Exception):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, per_second=REQUESTS_PER_SECOND, per_day=REQUESTS_PER_DAY):
+        self.per_second = per_second
+        self.per_day = per_day
+        self.recent = collections.deque()
+        self.day_start = time.monotonic()
+        self.day_count = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            now = time.monotonic()
+            if now - self.day_start >= 24 * 60 * 60:
+                self.day_start = now
+                self.day_count = 0
+            if self.day_count >= self.per_day:
+                raise QuotaExceededError(f"Daily quota of {self.per_day} requests used")
+
+            while True:
+                while self.recent and now - self.recent[0] >= 1:
+                    self.recent.popleft()
+                if len(self.recent) < self.per_second:
+                    break
+                await asyncio.sleep(1 - (now - self.recent[0]))
+                now = time.monotonic()
+
+            self.recent.append(now)
+            self.day_count += 1
+
+
+class AsyncNoaaClient:
+    def __init__(self, base_url=None, token=None, per_second=REQUESTS_PER_SECOND, per_day=REQUESTS_PER_DAY,
+                 max_connections=noaa_api_lib.MAX_POOL_CONNECTIONS, max_retries=MAX_RETRIES, cache=None):
+        self.base_url = base_url or noaa_api_lib.BASE_URL
+        self.token = token or noaa_api_lib.TOKEN
+        self.max_retries = max_retries
+        self.cache = cache if cache is not None else noaa_api_lib.get_cache()
+        self.limiter = RateLimiter(per_second, per_day)
+        self.connections = asyncio.Semaphore(max_connections)
+        # requests calls run on worker threads, so the pooled session is shared the same way the sync lib shares it
+        self.session = noaa_api_lib.build_session(max_connections)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.session.close()
+
+    async def request_json(self, endpoint, params):
+        headers = {"token": self.token}
+        key = entry = None
+        if self.cache is not None:
+            # Cache hits return before touching the rate limiter, so they cost no quota. The cache is sqlite, so its
+            # reads and writes run on worker threads like the requests themselves and never block the event loop.
+            key, entry, body = await asyncio.to_thread(self.cache.lookup, endpoint, params)
+            if body is not None:
+                return body
+            headers.update(self.cache.conditional_headers(entry))
+
+        for attempt in range(self.max_retries + 1):
+            await self.limiter.acquire()
+            async with self.connections:
+                r = await asyncio.to_thread(self.session.get, self.base_url + endpoint, headers=headers,
+                                            params=params, timeout=noaa_api_lib.REQUEST_TIMEOUT)
+            if r.status_code in RETRY_STATUS_CODES and attempt < self.max_retries:
+                delay = RETRY_BACKOFF * 2 ** attempt
+                logger.info(f"{endpoint} returned {r.status_code}. Retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+                continue
+            if self.cache is not None:
+                return await asyncio.to_thread(self.cache.store_response, key, endpoint, r, entry)
+            r.raise_for_status()
+            return r.json()
+
+    async def request_pages(self, endpoint, params, limit=None, max_results=noaa_api_lib.UP_TO_LIMIT):
+        page_size, max_results = noaa_api_lib.plan_result_pages(limit, max_results)
+        return await self.request_all_pages(endpoint, params, page_size, max_results)
+
+    async def request_all_pages(self, endpoint, params, limit, max_results=None):
+        # Fetch the first page for the resultset count, then every remaining page concurrently
+        first_offset = params.get("offset", 1)
+        first_page = await self.request_json(endpoint, {**params, "limit": limit, "offset": first_offset})
+        results = first_page.get("results", [])
+        if "metadata" in first_page:
+            count = first_page["metadata"]["resultset"]["count"]
+            offsets = noaa_api_lib.plan_page_offsets(count, limit, first_offset, max_results)
+            pages = await asyncio.gather(*(
+                self.request_json(endpoint, {**params, "limit": limit, "offset": offset}) for offset in offsets
+            ))
+            for page in pages:
+                results.extend(page.get("results", []))
+        return results if max_results is None else results[:max_results]
+
+    async def get_data_sets(
+            self,
+            datatypeid=None,
+            locationid=None,
+            stationid=None,
+            startdate=None,
+            enddate=None,
+            sortfield=None,
+            sortorder=None,
+            limit=None,
+            offset=None,
+            max_results=noaa_api_lib.UP_TO_LIMIT
+    ):
+        params_raw = {
+            "datatypeid": datatypeid,
+            "locationid": locationid,
+            "stationid": stationid,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_pages("datasets", params, limit, max_results)
+
+    async def get_data_categories(
+            self,
+            datasetid=None,
+            locationid=None,
+            stationid=None,
+            startdate=None,
+            enddate=None,
+            sortfield=None,
+            sortorder=None,
+            limit=None,
+            offset=None,
+            max_results=noaa_api_lib.UP_TO_LIMIT
+    ):
+        params_raw = {
+            "datasetid": datasetid,
+            "locationid": locationid,
+            "stationid": stationid,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_pages("datacategories", params, limit, max_results)
+
+    async def get_location_categories(
+            self,
+            datasetid=None,
+            startdate=None,
+            enddate=None,
+            sortfield=None,
+            sortorder=None,
+            limit=None,
+            offset=None,
+            max_results=noaa_api_lib.UP_TO_LIMIT
+    ):
+        params_raw = {
+            "datasetid": datasetid,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_pages("locationcategories", params, limit, max_results)
+
+    async def get_locations(
+            self,
+            datasetid=None,
+            locationcategoryid=None,
+            datacategoryid=None,
+            startdate=None,
+            enddate=None,
+            sortfield=None,
+            sortorder=None,
+            limit=None,
+            offset=None,
+            max_results=noaa_api_lib.UP_TO_LIMIT
+    ):
+        params_raw = {
+            "datasetid": datasetid,
+            "locationcategoryid": locationcategoryid,
+            "datacategoryid": datacategoryid,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_pages("locations", params, limit, max_results)
+
+    async def get_stations(
+            self,
+            datasetid=None,
+            locationid=None,
+            datacategoryid=None,
+            datatypeid=None,
+            extent=None,
+            startdate=None,
+            enddate=None,
+            sortfield=None,
+            sortorder=None,
+            genLimit=100,
+            limit=25,
+            offset=None
+    ):
+        params_raw = {
+            "datasetid": datasetid,
+            "locationid": locationid,
+            "datacategoryid": datacategoryid,
+            "datatypeid": datatypeid,
+            "extent": extent,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_all_pages("stations", params, limit, genLimit)
+
+    async def get_data(
+            self,
+            datasetid=None,
+            datatypeid=None,
+            locationid=None,
+            stationid=None,
+            startdate=None,
+            enddate=None,
+            units="standard",
+            sortfield=None,
+            sortorder=None,
+            limit=None,
+            offset=None,
+            max_results=noaa_api_lib.UP_TO_LIMIT,
+            inlucdemetadata=False
+    ):
+        params_raw = {
+            "datasetid": datasetid,
+            "locationid": locationid,
+            "stationid": stationid,
+            "datatypeid": datatypeid,
+            "units": units,
+            "startdate": startdate,
+            "enddate": enddate,
+            "sortfield": sortfield,
+            "sortorder": sortorder,
+            "offset": offset,
+        }
+        params = {k: v for k, v in params_raw.items() if v is not None}
+        return await self.request_pages("data", params, limit, max_results)
+
+    async def get_all_data(self, limit=1000, **kwargs):
+        params = {k: v for k, v in kwargs.items() if v is not None}
+        params.setdefault("units", "standard")
+        return await self.request_all_pages("data", params, limit)
+
+    async def get_data_for_stations(self, stationids, limit=1000, **kwargs):
+        # Every page of every station is in flight at once, the rate limiter keeps it inside the quota
+        results = await asyncio.gather(*(
+            self.get_all_data(limit=limit, stationid=stationid, **kwargs) for stationid in stationids
+        ))
+        return dict(zip(stationids, results))
@@ -0,0 +1,149 @@
+import os
+import sys
+import json
+import time
+import sqlite3
+import logging
+import pathlib
+import threading
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_cache_lib")
+
+DEFAULT_TTL = 7 * 24 * 60 * 60
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CacheMissError(Exception):
+    pass
+
+
+class ResponseCache:
+    def __init__(self, path, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES, offline=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.offline = offline
+        self.counters = {"hits": 0, "misses": 0, "revalidated": 0, "stale_served": 0, "evictions": 0}
+        self.lock = threading.Lock()
+
+        pathlib.Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # Shared by the paginator's prefetch threads, every access goes through self.lock
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("""CREATE TABLE if not exists responses (
+                            key text primary key,
+                            endpoint text,
+                            body blob,
+                            etag text,
+                            last_modified text,
+                            fetched_at real,
+                            accessed_at real,
+                            size integer
+                            );""")
+        self.conn.execute("CREATE INDEX if not exists responses_accessed_at_idx ON responses (accessed_at);")
+        self.conn.commit()
+
+    @staticmethod
+    def make_key(endpoint, params):
+        normalized = sorted((k, str(v)) for k, v in params.items() if v is not None)
+        return f"{endpoint}?{json.dumps(normalized)}"
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+        # Every hit or stale read is a request that did not count against the token quota
+        stats["requests_saved"] = stats["hits"] + stats["stale_served"]
+        return stats
+
+    def get_entry(self, key):
+        with self.lock:
+            row = self.conn.execute(
+                "select body, etag, last_modified, fetched_at from responses where key = ?;", (key,)).fetchone()
+            if row is not None:
+                self.conn.execute("update responses set accessed_at = ? where key = ?;", (time.time(), key))
+                self.conn.commit()
+        return row
+
+    def lookup(self, endpoint, params):
+        # Returns (key, entry, body). body is only set when the caller can skip the request entirely.
+        key = self.make_key(endpoint, params)
+        entry = self.get_entry(key)
+        if entry is not None and time.time() - entry[3] < self.ttl:
+            self.count("hits")
+            return key, entry, json.loads(entry[0])
+        if self.offline:
+            if entry is None:
+                self.count("misses")
+                raise CacheMissError(f"No cached response for {key} and the cache is offline")
+            self.count("stale_served")
+            return key, entry, json.loads(entry[0])
+        self.count("misses")
+        return key, entry, None
+
+    @staticmethod
+    def conditional_headers(entry):
+        headers = {}
+        if entry is not None and entry[1]:
+            headers["If-None-Match"] = entry[1]
+        if entry is not None and entry[2]:
+            headers["If-Modified-Since"] = entry[2]
+        return headers
+
+    def store_response(self, key, endpoint, response, entry):
+        if response.status_code == 304 and entry is not None:
+            self.count("revalidated")
+            with self.lock:
+                self.conn.execute("update responses set fetched_at = ? where key = ?;", (time.time(), key))
+                self.conn.commit()
+            return json.loads(entry[0])
+
+        response.raise_for_status()
+        body = response.content
+        now = time.time()
+        with self.lock:
+            self.conn.execute("""
+                INSERT INTO responses (key, endpoint, body, etag, last_modified, fetched_at, accessed_at, size)
+                values (?, ?, ?, ?, ?, ?, ?, ?)
+                on conflict (key) do update set body = excluded.body, etag = excluded.etag,
+                last_modified = excluded.last_modified, fetched_at = excluded.fetched_at,
+                accessed_at = excluded.accessed_at, size = excluded.size;""",
+                (key, endpoint, body, response.headers.get("ETag"), response.headers.get("Last-Modified"),
+                 now, now, len(body)))
+            self.evict()
+            self.conn.commit()
+        return json.loads(body)
+
+    def evict(self):
+        # Least recently used entries go first until the cache fits in max_bytes. Caller holds self.lock.
+        total = self.conn.execute("select coalesce(sum(size), 0) from responses;").fetchone()[0]
+        while total > self.max_bytes:
+            key, size = self.conn.execute(
+                "select key, size from responses order by accessed_at limit 1;").fetchone()
+            self.conn.execute("delete from responses where key = ?;", (key,))
+            self.counters["evictions"] += 1
+            total -= size
+
+    def close(self):
+        logger.info(f"Response cache stats: {self.stats()}")
+        with self.lock:
+            self.conn.close()
+
+
+def cache_from_env():
+    # NOAA_CACHE_PATH turns the cache on, NOAA_CACHE_OFFLINE=1 serves only from it
+    path = os.environ.get("NOAA_CACHE_PATH")
+    if not path:
+        return None
+    return ResponseCache(
+        path,
+        ttl=float(os.environ.get("NOAA_CACHE_TTL", DEFAULT_TTL)),
+        max_bytes=int(os.environ.get("NOAA_CACHE_MAX_BYTES", DEFAULT_MAX_BYTES)),
+        offline=os.environ.get("NOAA_CACHE_OFFLINE") == "1"
+    )
@@ -0,0 +1,72 @@
+# Every NORMAL_HLY category the ETL splits out, with the tables it lands in and its value columns.
+# Each value column has a matching <column>_completeness flag column in the split and staging data.
+CATEGORIES = {
+    "dewpt": {
+        "staging_table": "dewpt_staging",
+        "final_table": "hourly_dew_point_data",
+        "completeness_table": "hourly_dew_point_data_completeness",
+        "columns": [
+            "hourly_dew_point_tenth_percentile",
+            "hourly_dew_point_ninetieth_percentile",
+            "hourly_dew_point_mean"
+        ]
+    },
+    "pressure": {
+        "staging_table": "pressure_staging",
+        "final_table": "hourly_pressure_data",
+        "completeness_table": "hourly_pressure_data_completeness",
+        "columns": [
+            "hourly_sea_level_pressure_tenth_percentile",
+            "hourly_sea_level_pressure_ninetieth_percentile",
+            "hourly_sea_level_pressure_mean"
+        ]
+    },
+    "temp": {
+        "staging_table": "temp_staging",
+        "final_table": "hourly_temperature_data",
+        "completeness_table": "hourly_temperature_data_completeness",
+        "columns": [
+            "hourly_temperature_tenth_percentile",
+            "hourly_temperature_ninetieth_percentile",
+            "hourly_temperature_mean",
+            "hourly_cooling_degree_hours_mean",
+            "hourly_heating_degree_hours_mean",
+            "hourly_heat_index_mean"
+        ]
+    },
+    "wind": {
+        "staging_table": "wind_staging",
+        "final_table": "hourly_wind_data",
+        "completeness_table": "hourly_wind_data_completeness",
+        "columns": [
+            "hourly_wind_chill_mean",
+            "hourly_wind_prevailing_direction",
+            "hourly_wind_prevailing_percentage",
+            "hourly_wind_secondary_direction",
+            "hourly_wind_secondary_percentage",
+            "hourly_wind_average_speed",
+            "hourly_wind_percentage_calm",
+            "hourly_wind_mean_vector_direction",
+            "hourly_wind_mean_vector_magnitude"
+        ]
+    }
+}
+
+STATION_COLUMNS = [
+    "station",
+    "name",
+    "latitude",
+    "longitude",
+    "elevation"
+]
+
+KEY_COLUMNS = ["station", "date_time"]
+
+
+def get_completeness_columns(category):
+    return [f"{c}_completeness" for c in CATEGORIES[category]["columns"]]
+
+
+def get_category_columns(category):
+    # Key columns, then each value column followed by its completeness flag, the layout of the split files
+    return KEY_COLUMNS + [x for c in CATEGORIES[category]["columns"] for x in (c, f"{c}_completeness")]
@@ -0,0 +1,76 @@
+import sys
+import logging
+import threading
+from sqlalchemy import text
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_completeness_lib")
+
+# Completeness flags are single characters, so a separator and an empty string for NULL can not collide with a flag
+KEY_SEPARATOR = "|"
+
+
+def completeness_lock_sql(completeness_table):
+    # Serializes new-combination inserts across every loader and upsert touching this completeness table
+    return f"select pg_advisory_xact_lock(hashtext('{completeness_table}'));"
+
+
+def flags_to_key(flags):
+    return KEY_SEPARATOR.join("" if f is None else f for f in flags)
+
+
+class CompletenessCache:
+    def __init__(self, db_conn):
+        self.db_conn = db_conn
+        self.ids = {}
+        self.lock = threading.Lock()
+
+    def read_table(self, cur, completeness_table, columns):
+        rows = cur.execute(f"select id, {', '.join(columns)} from {completeness_table};").fetchall()
+        self.ids[completeness_table] = {flags_to_key(row[1:]): row[0] for row in rows}
+
+    def insert_combinations(self, completeness_table, columns, combinations):
+        with self.db_conn.begin() as cur:
+            if self.db_conn.dialect.name == "postgresql":
+                cur.execute(completeness_lock_sql(completeness_table))
+            # Another loader may have added some of these since the table was last read
+            self.read_table(cur, completeness_table, columns)
+            known = self.ids[completeness_table]
+            missing = [c for c in combinations if flags_to_key(c) not in known]
+            if not missing:
+                return
+
+            params = {}
+            values = []
+            for i, flags in enumerate(missing):
+                values.append("(" + ", ".join(f":f{i}_{j}" for j in range(len(columns))) + ")")
+                params.update({f"f{i}_{j}": flag for j, flag in enumerate(flags)})
+            rows = cur.execute(text(f"""
+                INSERT INTO {completeness_table} ({', '.join(columns)})
+                VALUES {', '.join(values)}
+                RETURNING id, {', '.join(columns)};"""), params).fetchall()
+            known.update({flags_to_key(row[1:]): row[0] for row in rows})
+            logger.info(f"Added {len(rows)} new combinations to {completeness_table}")
+
+    def get_ids(self, completeness_table, columns, combinations):
+        with self.lock:
+            if completeness_table not in self.ids:
+                with self.db_conn.connect() as cur:
+                    self.read_table(cur, completeness_table, columns)
+            if any(flags_to_key(c) not in self.ids[completeness_table] for c in combinations):
+                self.insert_combinations(completeness_table, columns, combinations)
+            return dict(self.ids[completeness_table])
+
+    def assign_ids(self, df, completeness_table, columns):
+        flag_columns = [f"{c}_completeness" for c in columns]
+        flags = df[flag_columns].astype(object).where(df[flag_columns].notna(), None)
+        keys = flags[flag_columns[0]].fillna("")
+        for c in flag_columns[1:]:
+            keys = keys + KEY_SEPARATOR + flags[c].fillna("")
+
+        combinations = list(flags.drop_duplicates().itertuples(index=False, name=None))
+        ids = self.get_ids(completeness_table, columns, combinations)
+        return keys.map(ids).astype("Int64")
@@ -1,4 +1,22 @@
+import os
+import functools
+import numpy as np
 import pandas as pd
+from noaa_etls.lib.noaa_trace_lib import traced, span, current_span
+
+DEFAULT_CHUNK_SIZE = 100000
+
+CATEGORY_COLUMNS = ["STATION", "NAME"]
+COORDINATE_COLUMNS = ["LATITUDE", "LONGITUDE", "ELEVATION"]
+# Elements NOAA publishes as whole numbers (percentages in tenths, direction codes). The rest carry a decimal.
+INTEGER_ELEMENTS = ["PCTBKN", "PCTCLR", "PCTFEW", "PCTOVC", "PCTSCT", "1STDIR", "1STPCT", "2NDDIR", "2NDPCT", "PCTCLM",
+                    "VCTDIR"]
+# float32 matches the real columns of the hourly tables, Int16 keeps missing values as NA
+VALUE_DTYPE = "float32"
+INTEGER_DTYPE = "Int16"
+FLAG_DTYPE = "category"
+
+NORMAL_HLY_DATE_WIDTH = len("MM-DDTHH:MM:SS")
 
 # Naming convention found here: https://www.ncei.noaa.gov/pub/data/cdo/documentation/NORMAL_HLY_documentation.pdf
 COL_NAME_TRANSLATOR = {
@@ -37,9 +55,101 @@ def col_translator(col_name):
     return "_".join(COL_NAME_TRANSLATOR.get(x, x).lower() for x in col_name_pieces)
 
 
+@functools.lru_cache(maxsize=None)
+def get_month_day_offsets(year):
+    year_start = np.datetime64(f"{year}-01-01", "D")
+    # Thirteen entries so offsets[m] - offsets[m - 1] is the length of month m
+    month_starts = np.arange(f"{year}-01", f"{year + 1}-02", dtype="datetime64[M]").astype("datetime64[D]")
+    offsets = (month_starts - year_start).astype(np.int64)
+    offsets.flags.writeable = False
+    return offsets
+
+
+@functools.lru_cache(maxsize=None)
+def get_year_hour_index(year):
+    # One slot per hour of the year (8760, or 8784 in leap years) plus a trailing slot for "12-31T24:00:00"
+    year_start = np.datetime64(f"{year}-01-01T00", "h")
+    n_hours = (np.datetime64(f"{year + 1}-01-01T00", "h") - year_start).astype(np.int64)
+    hour_index = (year_start + np.arange(n_hours + 1)).astype("datetime64[ns]")
+    hour_index.flags.writeable = False
+    return hour_index
+
+
+def parse_normal_hly_dates(date_col, year):
+    # NORMAL_HLY dates are fixed width "MM-DDTHH:MM:SS" with no year, so read the digits straight out of the bytes
+    year = int(year)
+    raw = np.asarray(date_col, dtype=f"S{NORMAL_HLY_DATE_WIDTH}")
+    chars = raw.view(np.uint8).reshape(-1, NORMAL_HLY_DATE_WIDTH)
+    if len(chars) and not ((chars[:, 2] == ord("-")) & (chars[:, 5] == ord("T"))).all():
+        raise ValueError("DATE column is not in the NORMAL_HLY MM-DDTHH:MM:SS format")
+
+    digits = chars.astype(np.int64) - ord("0")
+    month = digits[:, 0] * 10 + digits[:, 1]
+    day = digits[:, 3] * 10 + digits[:, 4]
+    hour = digits[:, 6] * 10 + digits[:, 7]
+    if len(chars) and ((month < 1) | (month > 12) | (hour < 0) | (hour > 24)).any():
+        raise ValueError("DATE column has an out of range month or hour")
+
+    month_offsets = get_month_day_offsets(year)
+    if len(chars) and ((day < 1) | (day > month_offsets[month] - month_offsets[month - 1])).any():
+        raise ValueError(f"DATE column has a day that does not exist in {year}")
+
+    slots = (month_offsets[month - 1] + day - 1) * 24 + hour
+    return pd.Series(get_year_hour_index(year)[slots], index=getattr(date_col, "index", None), name="date_time")
+
+
+def get_column_dtype(raw_col):
+    # Compact dtype for a raw NORMAL_HLY column name, None leaves it to pandas
+    if raw_col == "DATE":
+        return str
+    if raw_col in CATEGORY_COLUMNS or raw_col.endswith("_ATTRIBUTES"):
+        return FLAG_DTYPE
+    if raw_col in COORDINATE_COLUMNS:
+        return "float64"
+    if raw_col.startswith("HLY-"):
+        return INTEGER_DTYPE if raw_col.split("-")[-1] in INTEGER_ELEMENTS else VALUE_DTYPE
+    return None
+
+
+def get_raw_dtypes(raw_columns):
+    dtypes = {}
+    for c in raw_columns:
+        dtype = get_column_dtype(c)
+        if dtype is not None:
+            dtypes[c] = dtype
+    return dtypes
+
+
+def get_csv_dtypes(csv_path):
+    # Pinned up front so every chunk of a streamed file comes back with the same compact schema
+    header = pd.read_csv(csv_path, nrows=0).columns
+    return get_raw_dtypes(header)
+
+
+def rename_raw_df(raw_df, year):
+    # Rename in place rather than through DataFrame.rename so the raw frame is not copied
+    raw_df.columns = [col_translator(c) for c in raw_df.columns]
+    raw_df["date_time"] = parse_normal_hly_dates(raw_df["date_time"], year)
+    return raw_df
+
+
+@traced
 def load_csv_raw(csv_path, year):
-    raw_df = pd.read_csv(csv_path)
-    renamed_df = raw_df.rename(mapper=col_translator, axis="columns")
-    renamed_df["date_time"] = pd.to_datetime(renamed_df["date_time"].map(lambda x: f"{year}-{x}"))
-    return renamed_df
+    raw_df = pd.read_csv(csv_path, dtype=get_csv_dtypes(csv_path))
+    current_span().set(rows=len(raw_df), bytes_read=os.path.getsize(csv_path))
+    return rename_raw_df(raw_df, year)
+
+
+def iter_csv_raw(csv_path, year, chunk_size=DEFAULT_CHUNK_SIZE):
+    reader = pd.read_csv(csv_path, chunksize=chunk_size, dtype=get_csv_dtypes(csv_path))
+    with reader:
+        while True:
+            # The span closes before the yield, so it times the parse and not the consumer
+            with span("read_csv_chunk") as chunk_span:
+                raw_chunk = next(reader, None)
+                if raw_chunk is None:
+                    break
+                chunk = rename_raw_df(raw_chunk, year)
+                chunk_span.set(rows=len(chunk))
+            yield chunk
 
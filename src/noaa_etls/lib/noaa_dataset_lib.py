@@ -0,0 +1,131 @@
+import sys
+import shutil
+import pathlib
+import logging
+import pyarrow
+import pyarrow.dataset as ds
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_dataset_lib")
+
+DEFAULT_ROW_GROUP_SIZE = 100000
+DEFAULT_FLUSH_ROWS = 1000000
+DEFAULT_COMPRESSION = "zstd"
+CATEGORY_PARTITIONING = pyarrow.schema([("year", pyarrow.int16()), ("station", pyarrow.string())])
+STATION_PARTITIONING = pyarrow.schema([("station", pyarrow.string())])
+
+
+def get_category_dir(dataset_root, name):
+    return pathlib.Path(dataset_root, f"category={name}")
+
+
+def get_partitioning(partition_schema):
+    return ds.partitioning(partition_schema, flavor="hive")
+
+
+def get_partition_dir(category_dir, partition_values):
+    return pathlib.Path(category_dir, *(f"{k}={v}" for k, v in partition_values.items()))
+
+
+class PartitionedDatasetWriter:
+    # Buffers chunks of one category and writes them as a few large files per partition.
+    # overwrite=True replaces a partition the first time this writer touches it, otherwise files are added
+    # next to earlier runs. File names start with run_id, so rerunning the same input replaces its own files.
+    def __init__(self, dataset_root, name, partition_schema, run_id, overwrite=False,
+                 row_group_size=DEFAULT_ROW_GROUP_SIZE, compression=DEFAULT_COMPRESSION, dictionary_columns=None,
+                 flush_rows=DEFAULT_FLUSH_ROWS):
+        self.category_dir = get_category_dir(dataset_root, name)
+        self.partition_schema = partition_schema
+        self.run_id = run_id
+        self.overwrite = overwrite
+        self.row_group_size = row_group_size
+        self.flush_rows = flush_rows
+        self.file_options = ds.ParquetFileFormat().make_write_options(
+            compression=compression,
+            use_dictionary=dictionary_columns if dictionary_columns is not None else True
+        )
+        self.schema = None
+        self.tables = []
+        self.buffered_rows = 0
+        self.flushes = 0
+        self.cleared = set()
+        self.files = []
+
+    def clear_partitions(self, table):
+        partition_columns = self.partition_schema.names
+        partitions = table.select(partition_columns).group_by(partition_columns).aggregate([])
+        for values in zip(*(partitions[c].to_pylist() for c in partition_columns)):
+            if values in self.cleared:
+                continue
+            self.cleared.add(values)
+            partition_dir = get_partition_dir(self.category_dir, dict(zip(partition_columns, values)))
+            if partition_dir.exists():
+                logger.info(f"Overwriting partition {partition_dir}")
+                shutil.rmtree(partition_dir)
+
+    def write(self, table):
+        if self.overwrite:
+            self.clear_partitions(table)
+        # Later chunks are cast to the first chunk's schema
+        if self.schema is None:
+            self.schema = table.schema
+        else:
+            table = table.cast(self.schema)
+        self.tables.append(table)
+        self.buffered_rows += table.num_rows
+        if self.buffered_rows >= self.flush_rows:
+            self.flush()
+
+    def flush(self):
+        if not self.tables:
+            return
+        ds.write_dataset(
+            pyarrow.concat_tables(self.tables),
+            self.category_dir,
+            format="parquet",
+            partitioning=get_partitioning(self.partition_schema),
+            basename_template=f"{self.run_id}-{self.flushes}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+            file_options=self.file_options,
+            min_rows_per_group=self.row_group_size,
+            max_rows_per_group=self.row_group_size,
+            file_visitor=lambda written: self.files.append(written.path)
+        )
+        self.flushes += 1
+        self.tables = []
+        self.buffered_rows = 0
+
+    def close(self):
+        self.flush()
+        return self.files
+
+
+def open_category_dataset(dataset_root, name, partition_schema, run_id=None, filter=None):
+    # Fragments are pruned by their partition expression, so only matching directories are opened
+    category_dir = get_category_dir(dataset_root, name)
+    if not category_dir.exists():
+        return None
+    partitioning = get_partitioning(partition_schema)
+    dataset = ds.dataset(str(category_dir), format="parquet", partitioning=partitioning)
+    files = [fragment.path for fragment in dataset.get_fragments(filter=filter)
+             if run_id is None or pathlib.Path(fragment.path).name.startswith(f"{run_id}-")]
+    if not files:
+        return None
+    return ds.dataset(files, format="parquet", partitioning=partitioning, partition_base_dir=str(category_dir))
+
+
+def partition_filter(years=None, stations=None):
+    expressions = []
+    if years is not None:
+        expressions.append(ds.field("year").isin([int(y) for y in years]))
+    if stations is not None:
+        expressions.append(ds.field("station").isin(list(stations)))
+    if not expressions:
+        return None
+    expression = expressions[0]
+    for e in expressions[1:]:
+        expression = expression & e
+    return expression
@@ -0,0 +1,149 @@
+import io
+import sys
+import time
+import logging
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import QueuePool
+from noaa_etls.lib.noaa_trace_lib import traced, current_span
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_db_lib")
+
+DEFAULT_COPY_BATCH_SIZE = 50000
+DEFAULT_POOL_SIZE = 5
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 30
+DEFAULT_SESSION_PROFILE = "default"
+POOL_WAIT_WARNING_SECONDS = 1
+# Postgres settings applied to every connection an engine opens
+SESSION_PROFILES = {
+    "default": {},
+    # Staging is rebuilt from the source files, so a crash losing the last few commits only costs a reload
+    "bulk": {"synchronous_commit": "off", "work_mem": "256MB", "maintenance_work_mem": "1GB"},
+    "upsert": {"work_mem": "256MB"},
+    "maintenance": {"maintenance_work_mem": "1GB"}
+}
+
+
+class TimedQueuePool(QueuePool):
+    # Times every checkout, including any wait for a free connection, so pool starvation under parallel loads
+    # shows up on the calling span and in the log
+    def _do_get(self):
+        start_time = time.perf_counter()
+        conn = super()._do_get()
+        elapsed = time.perf_counter() - start_time
+        current_span().add(connections=1, connection_wait_seconds=elapsed)
+        if elapsed >= POOL_WAIT_WARNING_SECONDS:
+            logger.warning(f"Waited {elapsed:.2f}s for a db connection. {self.status()}")
+        return conn
+
+
+def get_session_options(profile, statement_timeout=None):
+    settings = dict(SESSION_PROFILES[profile])
+    if statement_timeout:
+        settings["statement_timeout"] = statement_timeout
+    return " ".join(f"-c {k}={v}" for k, v in settings.items())
+
+
+def create_db_engine(db_uri, profile=DEFAULT_SESSION_PROFILE, pool_size=DEFAULT_POOL_SIZE,
+                     max_overflow=DEFAULT_MAX_OVERFLOW, pool_timeout=DEFAULT_POOL_TIMEOUT, statement_timeout=None,
+                     isolation_level=None):
+    # The one place engines are made. Session settings ride along in the libpq startup packet, so they cost no
+    # extra round trip per connection.
+    engine_args = {}
+    if isolation_level is not None:
+        engine_args["isolation_level"] = isolation_level
+    if make_url(db_uri).get_backend_name() != "postgresql":
+        return create_engine(db_uri, **engine_args)
+    options = get_session_options(profile, statement_timeout)
+    if options:
+        engine_args["connect_args"] = {"options": options}
+    logger.info(f"Connecting with the {profile} session profile, pool_size={pool_size}, max_overflow={max_overflow}")
+    return create_engine(db_uri, poolclass=TimedQueuePool, pool_size=pool_size, max_overflow=max_overflow,
+                         pool_timeout=pool_timeout, **engine_args)
+
+
+def supports_copy(db_conn):
+    return db_conn.dialect.name == "postgresql"
+
+
+def create_table_from_df(db_conn, df, table_name):
+    # Let pandas pick the column types the same way to_sql always has, but without sending any rows
+    df.head(0).to_sql(table_name, db_conn, if_exists="append", index=False)
+
+
+def df_to_csv_buffer(df):
+    buf = io.StringIO()
+    # Empty unquoted fields are read back as NULL by COPY ... (FORMAT csv). Microseconds are kept like to_sql keeps
+    # them, load_time tells apart loads that start in the same second.
+    df.to_csv(buf, index=False, header=False, date_format="%Y-%m-%d %H:%M:%S.%f")
+    buf.seek(0)
+    return buf
+
+
+def copy_df_batches(raw_conn, df, table_name, batch_size):
+    cols_string = ", ".join(f'"{c}"' for c in df.columns)
+    copy_sql = f"COPY {table_name} ({cols_string}) FROM STDIN WITH (FORMAT csv)"
+    cursor = raw_conn.cursor()
+    bytes_written = 0
+    try:
+        for start in range(0, len(df), batch_size):
+            buf = df_to_csv_buffer(df.iloc[start:start + batch_size])
+            bytes_written += len(buf.getvalue())
+            cursor.copy_expert(copy_sql, buf)
+    finally:
+        cursor.close()
+    return bytes_written
+
+
+@traced
+def copy_dfs_to_table(db_conn, dfs, table_name, batch_size=DEFAULT_COPY_BATCH_SIZE):
+    # Copies an iterable of frames in one transaction, so a stream either lands whole or not at all.
+    # The table is created from the first frame.
+    start_time = time.perf_counter()
+    rows = 0
+    bytes_written = 0
+
+    if supports_copy(db_conn):
+        raw_conn = None
+        try:
+            for df in dfs:
+                if raw_conn is None:
+                    create_table_from_df(db_conn, df, table_name)
+                    raw_conn = db_conn.raw_connection()
+                bytes_written += copy_df_batches(raw_conn, df, table_name, batch_size)
+                rows += len(df)
+            if raw_conn is not None:
+                raw_conn.commit()
+        except Exception:
+            if raw_conn is not None:
+                raw_conn.rollback()
+            raise
+        finally:
+            if raw_conn is not None:
+                raw_conn.close()
+    else:
+        logger.info(f"{db_conn.dialect.name} does not support COPY. Falling back to to_sql for {table_name}")
+        for df in dfs:
+            df.to_sql(table_name, db_conn, if_exists="append", index=False, chunksize=batch_size)
+            rows += len(df)
+
+    elapsed = time.perf_counter() - start_time
+    current_span().set(table=table_name, rows=rows, bytes_written=bytes_written)
+    rows_per_sec = rows / elapsed if elapsed > 0 else float("inf")
+    logger.info(f"Loaded {rows} rows into {table_name} in {elapsed:.2f}s ({rows_per_sec:,.0f} rows/s)")
+    return rows
+
+
+def analyze_table(db_conn, table_name):
+    # Fresh statistics after a bulk load, so the planner sizes joins from real row counts instead of guesses
+    if db_conn.dialect.name == "postgresql":
+        db_conn.execute(f"ANALYZE {table_name};")
+
+
+def copy_df_to_table(db_conn, df, table_name, batch_size=DEFAULT_COPY_BATCH_SIZE):
+    return copy_dfs_to_table(db_conn, [df], table_name, batch_size)
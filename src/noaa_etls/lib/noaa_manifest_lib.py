@@ -0,0 +1,108 @@
+import os
+import sys
+import hashlib
+import logging
+import datetime
+from sqlalchemy import text
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_manifest_lib")
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def create_load_manifest_table(db_conn):
+    # One row per distinct source file content and load year, with the stat of the path it was last loaded from.
+    # The year comes from the command line, not the file, so the same file loaded for another year is another load.
+    db_conn.execute("""CREATE TABLE if not exists LOAD_MANIFEST (
+                    content_hash text,
+                    load_year integer,
+                    source_path text,
+                    file_size bigint,
+                    file_mtime_ns bigint,
+                    output_path text,
+                    rows_loaded bigint,
+                    loaded_at timestamp,
+                    primary key (content_hash, load_year)
+                    );""")
+    if not db_conn.execute("""
+            select exists (select 1 from information_schema.columns
+            where table_name = 'load_manifest' and column_name = 'load_year');""").first()[0]:
+        # Entries from before the year was recorded can not tell years apart, those files load once more
+        logger.info("Adding load_year to load_manifest and clearing entries recorded without it")
+        with db_conn.begin() as cur:
+            cur.execute("DELETE FROM load_manifest;")
+            cur.execute("ALTER TABLE load_manifest ADD COLUMN load_year integer;")
+            cur.execute("ALTER TABLE load_manifest DROP CONSTRAINT load_manifest_pkey, "
+                        "ADD PRIMARY KEY (content_hash, load_year);")
+    db_conn.execute("CREATE INDEX if not exists load_manifest_source_path_idx ON load_manifest (source_path);")
+
+
+def stat_file(path):
+    stat = os.stat(path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def hash_file(path, block_size=HASH_BLOCK_SIZE):
+    content_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def find_by_stat(db_conn, source_path, year, file_size, file_mtime_ns):
+    return db_conn.execute(text("""
+        select content_hash, output_path, loaded_at from load_manifest
+        where source_path = :source_path and load_year = :load_year and file_size = :file_size
+        and file_mtime_ns = :file_mtime_ns;"""),
+        {"source_path": source_path, "load_year": int(year), "file_size": file_size,
+         "file_mtime_ns": file_mtime_ns}).first()
+
+
+def find_by_hash(db_conn, content_hash, year):
+    return db_conn.execute(text("""
+        select content_hash, output_path, loaded_at from load_manifest
+        where content_hash = :content_hash and load_year = :load_year;"""),
+        {"content_hash": content_hash, "load_year": int(year)}).first()
+
+
+def fingerprint_file(db_conn, source_path, year):
+    # Returns (previous load or None, (size, mtime_ns, content_hash)). The file is only read when its stat
+    # does not match the manifest.
+    source_path = os.path.abspath(source_path)
+    file_size, file_mtime_ns = stat_file(source_path)
+    entry = find_by_stat(db_conn, source_path, year, file_size, file_mtime_ns)
+    if entry is not None:
+        return entry, (file_size, file_mtime_ns, entry[0])
+    content_hash = hash_file(source_path)
+    return find_by_hash(db_conn, content_hash, year), (file_size, file_mtime_ns, content_hash)
+
+
+def record_load(db_conn, source_path, year, fingerprint, output_path, rows_loaded):
+    file_size, file_mtime_ns, content_hash = fingerprint
+    db_conn.execute(text("""
+        INSERT INTO load_manifest (content_hash, load_year, source_path, file_size, file_mtime_ns, output_path,
+        rows_loaded, loaded_at)
+        values (:content_hash, :load_year, :source_path, :file_size, :file_mtime_ns, :output_path, :rows_loaded,
+        :loaded_at)
+        on conflict (content_hash, load_year) do update set source_path = excluded.source_path,
+        file_size = excluded.file_size, file_mtime_ns = excluded.file_mtime_ns,
+        output_path = excluded.output_path, rows_loaded = excluded.rows_loaded, loaded_at = excluded.loaded_at;"""),
+        {"content_hash": content_hash, "load_year": int(year), "source_path": os.path.abspath(source_path),
+         "file_size": file_size, "file_mtime_ns": file_mtime_ns, "output_path": output_path, "rows_loaded": rows_loaded,
+         "loaded_at": datetime.datetime.now()})
+
+
+def refresh_stat(db_conn, source_path, year, fingerprint):
+    # A touched or copied file with known content keeps its original load, only the stat used for the fast path moves.
+    # Loads of the same content for other years keep their own stat.
+    file_size, file_mtime_ns, content_hash = fingerprint
+    db_conn.execute(text("""
+        update load_manifest set source_path = :source_path, file_size = :file_size, file_mtime_ns = :file_mtime_ns
+        where content_hash = :content_hash and load_year = :load_year;"""),
+        {"content_hash": content_hash, "load_year": int(year), "source_path": os.path.abspath(source_path),
+         "file_size": file_size, "file_mtime_ns": file_mtime_ns})
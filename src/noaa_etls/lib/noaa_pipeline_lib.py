@@ -0,0 +1,56 @@
+import queue
+
+DEFAULT_QUEUE_SIZE = 4
+QUEUE_POLL_SECONDS = 0.1
+QUEUE_END = object()
+
+
+class PipelineCancelled(Exception):
+    pass
+
+
+def put_item(item_queue, item, cancelled):
+    # Bounded queues block a fast stage behind a slow one. Polling lets a blocked stage notice another one failed.
+    while not cancelled.is_set():
+        try:
+            item_queue.put(item, timeout=QUEUE_POLL_SECONDS)
+            return
+        except queue.Full:
+            continue
+    raise PipelineCancelled()
+
+
+def iter_queue(item_queue, cancelled):
+    while not cancelled.is_set():
+        try:
+            item = item_queue.get(timeout=QUEUE_POLL_SECONDS)
+        except queue.Empty:
+            continue
+        if item is QUEUE_END:
+            return
+        yield item
+    raise PipelineCancelled()
+
+
+def fill_queue(item_queue, items, cancelled):
+    for item in items:
+        put_item(item_queue, item, cancelled)
+    put_item(item_queue, QUEUE_END, cancelled)
+
+
+def run_stage(cancelled, func, *args):
+    # A failing stage cancels every other stage, so no producer waits forever on a consumer that is gone
+    try:
+        return func(*args)
+    except BaseException:
+        cancelled.set()
+        raise
+
+
+def get_stage_results(futures):
+    # Waits for every stage, then raises the error that started a cancellation rather than the ones it caused
+    errors = [f.exception() for f in futures if f.exception() is not None]
+    root_errors = [e for e in errors if not isinstance(e, PipelineCancelled)]
+    if errors:
+        raise (root_errors or errors)[0]
+    return [f.result() for f in futures]
@@ -0,0 +1,248 @@
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import resource
+import functools
+import threading
+import itertools
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logging.basicConfig(
+    level=logging.INFO,
+    handlers=[logging.StreamHandler(stream=sys.stdout)]
+)
+logger = logging.getLogger("noaa_trace_lib")
+
+SQL_TEXT_LIMIT = 200
+METRIC_PREFIX = "noaa_etl"
+COUNTER_ATTRIBUTES = ["rows", "bytes_read", "bytes_written", "connections", "connection_wait_seconds"]
+
+
+def max_rss_bytes():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+class NoopSpan:
+    # Handed out while tracing is off, so instrumented code never has to check
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def set(self, **attributes):
+        pass
+
+    def add(self, **counts):
+        pass
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Span:
+    def __init__(self, tracer, name, attributes):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span_id = next(tracer.ids)
+        self.parent_id = None
+        self.start_time = None
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent_id = stack[-1].span_id if stack else None
+        stack.append(self)
+        self.start_time = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.perf_counter() - self.start_time
+        self.tracer.stack().pop()
+        self.tracer.finish(self, duration, exc_type)
+        return False
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **counts):
+        # Worker threads running under this span add to it concurrently
+        with self.tracer.lock:
+            for k, v in counts.items():
+                self.attributes[k] = self.attributes.get(k, 0) + v
+
+
+class Tracer:
+    # Spans nest per thread. Each finished span is written to the JSON lines file as it ends, and totals per span
+    # name are kept for the Prometheus textfile written on close.
+    def __init__(self, jsonl_path=None, prom_path=None):
+        self.jsonl_path = jsonl_path
+        self.prom_path = prom_path
+        self.jsonl_file = open(jsonl_path, "a") if jsonl_path else None
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.ids = itertools.count(1)
+        self.totals = {}
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def current(self):
+        stack = self.stack()
+        return stack[-1] if stack else NOOP_SPAN
+
+    def finish(self, span, duration, exc_type):
+        record = {
+            "span_id": span.span_id,
+            "parent_id": span.parent_id,
+            "name": span.name,
+            "thread": threading.current_thread().name,
+            "seconds": round(duration, 6),
+            "max_rss_bytes": max_rss_bytes(),
+            "error": exc_type.__name__ if exc_type else None,
+            **span.attributes
+        }
+        with self.lock:
+            totals = self.totals.setdefault(span.name, {"calls": 0, "seconds": 0.0, "errors": 0,
+                                                        **{k: 0 for k in COUNTER_ATTRIBUTES}})
+            totals["calls"] += 1
+            totals["seconds"] += duration
+            totals["errors"] += exc_type is not None
+            for k in COUNTER_ATTRIBUTES:
+                totals[k] += span.attributes.get(k) or 0
+            if self.jsonl_file is not None:
+                self.jsonl_file.write(json.dumps(record, default=str) + "\n")
+                self.jsonl_file.flush()
+
+    def write_prometheus(self):
+        lines = [
+            f"# TYPE {METRIC_PREFIX}_span_seconds_total counter",
+            f"# TYPE {METRIC_PREFIX}_span_calls_total counter",
+            f"# TYPE {METRIC_PREFIX}_span_errors_total counter",
+            *(f"# TYPE {METRIC_PREFIX}_{k}_total counter" for k in COUNTER_ATTRIBUTES),
+            f"# TYPE {METRIC_PREFIX}_peak_rss_bytes gauge"
+        ]
+        with self.lock:
+            for name, totals in sorted(self.totals.items()):
+                label = '{span="' + name.replace("\\", "\\\\").replace('"', '\\"') + '"}'
+                lines.append(f"{METRIC_PREFIX}_span_seconds_total{label} {totals['seconds']:.6f}")
+                lines.append(f"{METRIC_PREFIX}_span_calls_total{label} {totals['calls']}")
+                lines.append(f"{METRIC_PREFIX}_span_errors_total{label} {totals['errors']}")
+                for k in COUNTER_ATTRIBUTES:
+                    lines.append(f"{METRIC_PREFIX}_{k}_total{label} {totals[k]}")
+        lines.append(f"{METRIC_PREFIX}_peak_rss_bytes {max_rss_bytes()}")
+        # The node exporter textfile collector may read at any time, so swap the whole file in at once
+        tmp_path = f"{self.prom_path}.tmp"
+        with open(tmp_path, "w") as prom_file:
+            prom_file.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, self.prom_path)
+
+    def close(self):
+        if self.prom_path:
+            self.write_prometheus()
+        if self.jsonl_file is not None:
+            self.jsonl_file.close()
+
+
+tracer = None
+
+
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    sql_span = Span(tracer, "sql", {"statement": " ".join(statement.split())[:SQL_TEXT_LIMIT]})
+    conn.info.setdefault("trace_spans", []).append(sql_span.__enter__())
+
+
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    sql_span = conn.info["trace_spans"].pop()
+    if cursor.rowcount is not None and cursor.rowcount >= 0:
+        sql_span.set(rows=cursor.rowcount)
+    sql_span.__exit__(None, None, None)
+
+
+def handle_error(exception_context):
+    spans = exception_context.connection.info.get("trace_spans") if exception_context.connection else None
+    if spans:
+        spans.pop().__exit__(type(exception_context.original_exception), None, None)
+
+
+def configure_tracing(jsonl_path=None, prom_path=None):
+    # SQL timing hooks are only registered while tracing is on, so a disabled run pays nothing for them
+    global tracer
+    if tracer is not None:
+        close_tracing()
+    if not jsonl_path and not prom_path:
+        return None
+    tracer = Tracer(jsonl_path, prom_path)
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    event.listen(Engine, "after_cursor_execute", after_cursor_execute)
+    event.listen(Engine, "handle_error", handle_error)
+    atexit.register(close_tracing)
+    logger.info(f"Tracing to {jsonl_path or ''} {prom_path or ''}".rstrip())
+    return tracer
+
+
+def configure_tracing_from_env():
+    # NOAA_TRACE_JSONL and NOAA_TRACE_PROM name the outputs, tracing stays off when neither is set
+    return configure_tracing(os.environ.get("NOAA_TRACE_JSONL"), os.environ.get("NOAA_TRACE_PROM"))
+
+
+def close_tracing():
+    global tracer
+    if tracer is None:
+        return
+    event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    event.remove(Engine, "after_cursor_execute", after_cursor_execute)
+    event.remove(Engine, "handle_error", handle_error)
+    atexit.unregister(close_tracing)
+    closing, tracer = tracer, None
+    closing.close()
+
+
+def span(name, **attributes):
+    if tracer is None:
+        return NOOP_SPAN
+    return Span(tracer, name, attributes)
+
+
+def current_span():
+    if tracer is None:
+        return NOOP_SPAN
+    return tracer.current()
+
+
+def in_current_span(func):
+    # Span stacks are per thread, so work handed to a pool would start with no parent. Wrapping it where it is
+    # submitted runs it under the submitter's span instead.
+    active = tracer
+    if active is None or not active.stack():
+        return func
+    parent = active.current()
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        stack = active.stack()
+        stack.append(parent)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            stack.pop()
+    return wrapper
+
+
+def traced(func):
+    # Wraps func in a span named after it. With tracing off the wrapper is one global lookup.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if tracer is None:
+            return func(*args, **kwargs)
+        with Span(tracer, func.__name__, {}):
+            return func(*args, **kwargs)
+    return wrapper
@@ -0,0 +1,60 @@
+# Offline checks of the sync client's paging against a stubbed request_json. Run with
+# PYTHONPATH=src python -m pytest tests
+import pytest
+from noaa_etls.lib import noaa_api_lib
+
+RESULT_COUNT = 53
+
+
+@pytest.fixture
+def requests_made(monkeypatch):
+    requests_made = []
+
+    def request_json(endpoint, params):
+        requests_made.append(params)
+        offset, limit = params.get("offset", 1), params.get("limit", noaa_api_lib.API_DEFAULT_LIMIT)
+        results = [{"i": i} for i in range(offset, min(offset + limit, RESULT_COUNT + 1))]
+        if not results:
+            return {}
+        return {"metadata": {"resultset": {"offset": offset, "count": RESULT_COUNT, "limit": limit}},
+                "results": results}
+
+    monkeypatch.setattr(noaa_api_lib, "request_json", request_json)
+    return requests_made
+
+
+@pytest.mark.parametrize("prefetch", [0, 1, 2, 5])
+def test_paginate_returns_every_page_for_any_prefetch(requests_made, prefetch):
+    results = noaa_api_lib.paginate("data", {}, 10, prefetch=prefetch)
+    assert [r["i"] for r in results] == list(range(1, RESULT_COUNT + 1))
+    assert len(requests_made) == 6
+
+
+@pytest.mark.parametrize("prefetch", [0, 2])
+def test_paginate_stops_at_max_results(requests_made, prefetch):
+    results = noaa_api_lib.paginate("data", {}, 10, max_results=17, prefetch=prefetch)
+    assert [r["i"] for r in results] == list(range(1, 18))
+
+
+def test_limit_caps_results_in_one_request(requests_made):
+    assert len(noaa_api_lib.get_data(limit=10)) == 10
+    assert len(requests_made) == 1
+
+
+def test_no_limit_returns_the_api_default_page(requests_made):
+    assert len(noaa_api_lib.get_locations()) == noaa_api_lib.API_DEFAULT_LIMIT
+    assert len(requests_made) == 1
+
+
+def test_max_results_opts_in_to_more_pages(requests_made):
+    assert len(noaa_api_lib.get_data_sets(limit=10, max_results=30)) == 30
+    assert len(requests_made) == 3
+    assert len(noaa_api_lib.get_data_categories(max_results=None)) == RESULT_COUNT
+
+
+def test_offset_starts_the_results_there(requests_made):
+    assert [r["i"] for r in noaa_api_lib.get_location_categories(offset=50, max_results=None)] == [50, 51, 52, 53]
+
+
+def test_empty_resultset_is_an_empty_list(requests_made):
+    assert noaa_api_lib.get_data(offset=RESULT_COUNT + 1) == []
@@ -0,0 +1,209 @@
+# Offline checks of the async client against a local stub of the CDO API. Run with
+# PYTHONPATH=src python -m pytest tests
+import json
+import time
+import asyncio
+import threading
+import urllib.parse
+import http.server
+import pytest
+from noaa_etls.lib import noaa_api_lib, noaa_async_api_lib
+from noaa_etls.lib.noaa_async_api_lib import AsyncNoaaClient, RateLimiter, QuotaExceededError
+from noaa_etls.lib.noaa_cache_lib import ResponseCache
+
+
+class StubApi:
+    # Answers each request from respond(endpoint, params), and counts requests and how many were in flight at once
+    def __init__(self, respond, delay=0.0):
+        self.respond = respond
+        self.delay = delay
+        self.requests = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def handle(self, handler):
+        url = urllib.parse.urlparse(handler.path)
+        endpoint = url.path.strip("/")
+        params = {k: v[0] for k, v in urllib.parse.parse_qs(url.query).items()}
+        with self.lock:
+            self.requests.append((endpoint, params, handler.headers.get("token")))
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            time.sleep(self.delay)
+            status, body = self.respond(endpoint, params)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+        content = json.dumps(body).encode() if body is not None else b""
+        handler.send_response(status)
+        handler.send_header("Content-Type", "application/json")
+        handler.send_header("Content-Length", str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+@pytest.fixture
+def serve():
+    servers = []
+
+    def serve(respond, delay=0.0):
+        api = StubApi(respond, delay)
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                api.handle(self)
+
+            def log_message(self, *args):
+                pass
+
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        api.base_url = f"http://127.0.0.1:{server.server_address[1]}/"
+        return api
+
+    yield serve
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def offline_client(monkeypatch):
+    # Short retry backoff, and no response cache unless a test passes one
+    monkeypatch.setattr(noaa_async_api_lib, "RETRY_BACKOFF", 0.01)
+    monkeypatch.setattr(noaa_api_lib, "_cache", None)
+    monkeypatch.setattr(noaa_api_lib, "_cache_configured", True)
+
+
+def make_client(api, **kwargs):
+    kwargs.setdefault("per_second", 1000)
+    return AsyncNoaaClient(base_url=api.base_url, token="test-token", **kwargs)
+
+
+def paged_results(count):
+    def respond(endpoint, params):
+        offset, limit = int(params["offset"]), int(params["limit"])
+        results = [{"i": i} for i in range(offset, min(offset + limit, count + 1))]
+        return 200, {"metadata": {"resultset": {"offset": offset, "count": count, "limit": limit}},
+                     "results": results}
+    return respond
+
+
+def test_rate_limiter_spaces_requests_to_the_per_second_quota():
+    async def acquire_all(limiter, n):
+        start = time.monotonic()
+        for _ in range(n):
+            await limiter.acquire()
+        return time.monotonic() - start
+
+    # The first 5 go at once, the 6th waits for the first to be a second old
+    assert asyncio.run(acquire_all(RateLimiter(per_second=5), 5)) < 0.5
+    assert asyncio.run(acquire_all(RateLimiter(per_second=5), 6)) >= 0.95
+
+
+def test_rate_limiter_raises_once_the_daily_quota_is_used():
+    async def acquire_all(limiter, n):
+        for _ in range(n):
+            await limiter.acquire()
+
+    asyncio.run(acquire_all(RateLimiter(per_day=3), 3))
+    with pytest.raises(QuotaExceededError):
+        asyncio.run(acquire_all(RateLimiter(per_day=3), 4))
+
+
+def test_client_requests_go_through_the_rate_limiter(serve):
+    api = serve(lambda endpoint, params: (200, {"results": []}))
+
+    async def run():
+        async with make_client(api, per_second=3) as client:
+            start = time.monotonic()
+            await asyncio.gather(*(client.request_json("datasets", {"offset": i}) for i in range(4)))
+            return time.monotonic() - start
+
+    assert asyncio.run(run()) >= 0.95
+    assert len(api.requests) == 4
+    assert all(token == "test-token" for _, _, token in api.requests)
+
+
+@pytest.mark.parametrize("status", [429, 500, 502, 503, 504])
+def test_retryable_statuses_are_retried(serve, status):
+    responses = [(status, None), (status, None), (200, {"results": [1]})]
+    api = serve(lambda endpoint, params: responses.pop(0))
+
+    async def run():
+        async with make_client(api) as client:
+            return await client.request_json("datasets", {})
+
+    assert asyncio.run(run()) == {"results": [1]}
+    assert len(api.requests) == 3
+
+
+def test_retries_give_up_after_max_retries(serve):
+    api = serve(lambda endpoint, params: (503, None))
+
+    async def run():
+        async with make_client(api, max_retries=2) as client:
+            return await client.request_json("datasets", {})
+
+    with pytest.raises(Exception, match="503"):
+        asyncio.run(run())
+    assert len(api.requests) == 3
+
+
+def test_other_errors_are_not_retried(serve):
+    api = serve(lambda endpoint, params: (400, None))
+
+    async def run():
+        async with make_client(api) as client:
+            return await client.request_json("datasets", {})
+
+    with pytest.raises(Exception, match="400"):
+        asyncio.run(run())
+    assert len(api.requests) == 1
+
+
+def test_pages_after_the_first_are_fetched_concurrently(serve):
+    api = serve(paged_results(53), delay=0.1)
+
+    async def run():
+        async with make_client(api) as client:
+            return await client.get_all_data(limit=10, datasetid="NORMAL_HLY")
+
+    results = asyncio.run(run())
+    assert [r["i"] for r in results] == list(range(1, 54))
+    assert sorted(int(params["offset"]) for _, params, _ in api.requests) == [1, 11, 21, 31, 41, 51]
+    assert api.max_in_flight > 1
+
+
+def test_pages_for_many_stations_share_the_connection_limit(serve):
+    api = serve(paged_results(25), delay=0.05)
+
+    async def run():
+        async with make_client(api, max_connections=2) as client:
+            return await client.get_data_for_stations(["A", "B", "C"], limit=10)
+
+    results = asyncio.run(run())
+    assert {station: len(rows) for station, rows in results.items()} == {"A": 25, "B": 25, "C": 25}
+    assert len(api.requests) == 9
+    assert api.max_in_flight <= 2
+
+
+def test_cache_hits_cost_no_quota(serve, tmp_path):
+    api = serve(lambda endpoint, params: (200, {"results": [1]}))
+    cache = ResponseCache(str(tmp_path / "cache.sqlite"))
+
+    async def run():
+        async with make_client(api, cache=cache, per_day=1) as client:
+            first = await client.request_json("datasets", {})
+            # Over the daily quota of 1, but served from the cache
+            second = await client.request_json("datasets", {})
+            return first, second
+
+    try:
+        assert asyncio.run(run()) == ({"results": [1]}, {"results": [1]})
+    finally:
+        cache.close()
+    assert len(api.requests) == 1
@@ -0,0 +1,150 @@
+# Offline checks of the API response cache against a stubbed session. Run with
+# PYTHONPATH=src python -m pytest tests
+import json
+import pytest
+from noaa_etls.lib import noaa_api_lib, noaa_cache_lib
+from noaa_etls.lib.noaa_cache_lib import ResponseCache, CacheMissError
+
+
+class StubResponse:
+    def __init__(self, status_code, body=None, etag=None):
+        self.status_code = status_code
+        self.content = json.dumps(body).encode() if body is not None else b""
+        self.headers = {"ETag": etag} if etag else {}
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise RuntimeError(f"HTTP {self.status_code}")
+
+    def json(self):
+        return json.loads(self.content)
+
+
+class StubSession:
+    # Serves queued responses in order and records the headers of every request
+    def __init__(self):
+        self.responses = []
+        self.requests = []
+
+    def get(self, url, headers=None, params=None, timeout=None):
+        self.requests.append((url, headers, params))
+        return self.responses.pop(0)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(noaa_cache_lib.time, "time", clock.time)
+    return clock
+
+
+@pytest.fixture
+def session(monkeypatch):
+    session = StubSession()
+    monkeypatch.setattr(noaa_api_lib, "_session", session)
+    return session
+
+
+@pytest.fixture
+def make_cache(tmp_path, monkeypatch):
+    caches = []
+
+    def make_cache(**kwargs):
+        cache = ResponseCache(str(tmp_path / "cache.sqlite"), **kwargs)
+        noaa_api_lib.configure_cache(cache)
+        caches.append(cache)
+        return cache
+
+    yield make_cache
+    for cache in caches:
+        cache.close()
+    noaa_api_lib.configure_cache(None)
+    monkeypatch.setattr(noaa_api_lib, "_cache_configured", False)
+
+
+def test_fresh_entry_is_served_without_a_request(clock, session, make_cache):
+    cache = make_cache(ttl=60)
+    session.responses.append(StubResponse(200, {"results": [1]}, etag='"v1"'))
+
+    assert noaa_api_lib.request_json("datasets", {"limit": 5}) == {"results": [1]}
+    clock.now += 59
+    assert noaa_api_lib.request_json("datasets", {"limit": 5}) == {"results": [1]}
+
+    assert len(session.requests) == 1
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_expired_entry_is_revalidated_with_its_etag(clock, session, make_cache):
+    cache = make_cache(ttl=60)
+    session.responses.append(StubResponse(200, {"results": [1]}, etag='"v1"'))
+    noaa_api_lib.request_json("datasets", {})
+
+    clock.now += 61
+    session.responses.append(StubResponse(304))
+    assert noaa_api_lib.request_json("datasets", {}) == {"results": [1]}
+    assert session.requests[-1][1]["If-None-Match"] == '"v1"'
+    assert cache.stats()["revalidated"] == 1
+
+    # The 304 restarted the TTL
+    clock.now += 59
+    assert noaa_api_lib.request_json("datasets", {}) == {"results": [1]}
+    assert len(session.requests) == 2
+
+
+def test_expired_entry_is_replaced_by_a_changed_response(clock, session, make_cache):
+    make_cache(ttl=60)
+    session.responses.append(StubResponse(200, {"results": [1]}, etag='"v1"'))
+    noaa_api_lib.request_json("datasets", {})
+
+    clock.now += 61
+    session.responses.append(StubResponse(200, {"results": [2]}, etag='"v2"'))
+    assert noaa_api_lib.request_json("datasets", {}) == {"results": [2]}
+    assert noaa_api_lib.request_json("datasets", {}) == {"results": [2]}
+    assert len(session.requests) == 2
+
+
+def test_offline_serves_stale_entries_and_raises_on_misses(clock, session, make_cache):
+    cache = make_cache(ttl=60)
+    session.responses.append(StubResponse(200, {"results": [1]}))
+    noaa_api_lib.request_json("datasets", {})
+    cache.close()
+
+    clock.now += 3600
+    offline_cache = make_cache(ttl=60, offline=True)
+    assert noaa_api_lib.request_json("datasets", {}) == {"results": [1]}
+    with pytest.raises(CacheMissError):
+        noaa_api_lib.request_json("stations", {})
+
+    assert len(session.requests) == 1
+    assert offline_cache.stats()["stale_served"] == 1
+    assert offline_cache.stats()["requests_saved"] == 1
+
+
+def test_least_recently_used_entry_is_evicted(clock, session, make_cache):
+    body = {"results": ["x" * 100]}
+    entry_size = len(json.dumps(body).encode())
+    cache = make_cache(max_bytes=2 * entry_size)
+    for endpoint in ["a", "b"]:
+        session.responses.append(StubResponse(200, body))
+        noaa_api_lib.request_json(endpoint, {})
+        clock.now += 1
+
+    # Reading a makes b the least recently used
+    noaa_api_lib.request_json("a", {})
+    clock.now += 1
+    session.responses.append(StubResponse(200, body))
+    noaa_api_lib.request_json("c", {})
+
+    assert cache.stats()["evictions"] == 1
+    assert cache.get_entry(cache.make_key("a", {})) is not None
+    assert cache.get_entry(cache.make_key("b", {})) is None
+    assert cache.get_entry(cache.make_key("c", {})) is not None